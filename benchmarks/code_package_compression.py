@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+"""
+Compares the compression codecs for tar code packages on a directory:
+package size, pack time and unpack time. Nothing is uploaded.
+
+    python benchmarks/code_package_compression.py ~/my-project --exclude .git --exclude '*.pt'
+"""
+
+import os
+import tempfile
+from argparse import ArgumentParser
+from fnmatch import fnmatch
+from time import perf_counter
+
+from jobmonitor.api import extract_tar_package, write_tar_package
+from jobmonitor.compression import CODECS
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("directory", nargs="?", default=".")
+    parser.add_argument("--exclude", action="append", default=[], help="basename pattern")
+    parser.add_argument("--codec", action="append", choices=CODECS, help="default: all")
+    parser.add_argument("--repeat", type=int, default=3, help="report the fastest of n runs")
+    args = parser.parse_args()
+
+    def filter_fn(tarinfo):
+        basename = os.path.basename(tarinfo.name)
+        if any(fnmatch(basename, pattern) for pattern in args.exclude):
+            return None
+        return tarinfo
+
+    print(f"{'codec':<6} {'size (MB)':>10} {'ratio':>6} {'pack (s)':>9} {'unpack (s)':>11}")
+    raw_size = None
+    # Uncompressed first, it is the reference for the compression ratio
+    for codec in sorted(args.codec or CODECS, key=lambda codec: codec != "none"):
+        try:
+            pack_times, unpack_times = [], []
+            for _ in range(args.repeat):
+                with tempfile.TemporaryFile() as package, tempfile.TemporaryDirectory() as dest:
+                    start = perf_counter()
+                    write_tar_package(args.directory, package, codec, filter=filter_fn)
+                    package.flush()
+                    pack_times.append(perf_counter() - start)
+                    size = package.tell()
+
+                    package.seek(0)
+                    start = perf_counter()
+                    extract_tar_package(package, dest, codec)
+                    unpack_times.append(perf_counter() - start)
+        except ImportError as e:
+            print(f"{codec:<6} skipped ({e.name} is not installed)")
+            continue
+
+        if codec == "none":
+            raw_size = size
+        ratio = f"{raw_size / size:.2f}" if raw_size else ""
+        print(
+            f"{codec:<6} {size / 1e6:>10.2f} {ratio:>6} "
+            f"{min(pack_times):>9.3f} {min(unpack_times):>11.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+"""
+Throughput and call latency of the worker-side logging path: what a training loop pays
+for printing (MongoLogChannel, FileLogChannel, MultiLogChannel), log_metric, log_info
+and heartbeats, with several workers at a time.
+
+By default, database writes go to an in-process stand-in that only BSON-encodes them,
+which isolates the cost on the worker's side. With --mongodb, they go to the server
+configured with JOBMONITOR_METADATA_*, in a separate database that is dropped afterwards.
+
+    python benchmarks/logging_path.py
+    python benchmarks/logging_path.py --mongodb --workers 1 4 16 --duration 10
+"""
+
+import multiprocessing
+import os
+import tempfile
+import threading
+from argparse import ArgumentParser
+from time import perf_counter, sleep
+
+import bson
+from bson.objectid import ObjectId
+
+from jobmonitor import connections, heartbeat, job_queue, run
+from jobmonitor.api import update_job
+from jobmonitor.histogram import LatencyHistogram
+
+# Calls per second per worker. Lines and metrics are typical of a busy training loop,
+# log_info and heartbeats are much rarer in practice but measured at this rate.
+RATES = {
+    "file_log": 1000,
+    "mongo_log": 1000,
+    "multi_log": 1000,
+    "log_metric": 10_000,
+    "log_info": 100,
+    "heartbeat": 100,
+}
+
+LINE = "epoch 3, step 1234/5000, loss 0.123456, accuracy 0.9876, 1234.5 samples/s\n"
+
+
+class StandInDatabase:
+    """Accepts the writes of the logging path in any collection and counts their BSON size"""
+
+    def __init__(self):
+        self.bytes_written = 0
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return StandInCollection(self)
+
+    def count(self, *documents):
+        size = sum(len(bson.encode(document)) for document in documents)
+        with self._lock:
+            self.bytes_written += size
+
+
+class StandInCollection:
+    def __init__(self, database):
+        self.database = database
+
+    def with_options(self, **kwargs):
+        return self
+
+    def create_index(self, *args, **kwargs):
+        pass
+
+    def update(self, spec, document, **kwargs):
+        self.database.count(spec, document)
+
+    def update_one(self, filter, update, **kwargs):
+        self.database.count(filter, update)
+
+    def bulk_write(self, requests, **kwargs):
+        for request in requests:
+            self.database.count(request["filter"], request["update"])
+
+
+def stand_in_update_one(filter, update, upsert=False):
+    """Replaces pymongo's UpdateOne, whose contents are private, for the stand-in database"""
+    return {"filter": filter, "update": update}
+
+
+def make_workload(name, db, job_id, rank, n_workers, log_file):
+    """A function called with the iteration number, and one that drains buffers afterwards"""
+    log_bucket = db.log_bucket if run.LOG_STORAGE == "bucket" else None
+    metric_bucket = db.metric_bucket if run.METRIC_STORAGE == "bucket" else None
+
+    def mongo_channel():
+        return run.MongoLogChannel(
+            db.job,
+            job_id,
+            tags={"worker": rank, "type": "info"},
+            buffer_lines=run.LOG_BUFFER_LINES,
+            flush_interval=run.LOG_FLUSH_INTERVAL,
+            bucket_collection=log_bucket,
+        )
+
+    if name == "file_log":
+        channel = run.FileLogChannel(log_file)
+        return lambda i: channel.write(LINE), lambda: None
+    elif name == "mongo_log":
+        channel = mongo_channel()
+        return lambda i: channel.write(LINE), channel.close
+    elif name == "multi_log":
+        # What `print` goes through in a job: database, terminal and output file
+        terminal = open(os.devnull, "w")
+        channel = run.MultiLogChannel(mongo_channel(), terminal, run.FileLogChannel(log_file))
+        return lambda i: channel.write(LINE), channel.close
+    elif name == "log_metric":
+        metric_buffer = run.MetricBuffer(
+            db.job,
+            job_id,
+            bucket_collection=metric_bucket,
+            max_points=run.METRIC_BUFFER_POINTS,
+            flush_interval=run.METRIC_FLUSH_INTERVAL,
+        )
+        log_metric = run.metric_logger(metric_buffer, rank, n_workers)
+        return lambda i: log_metric("loss", 1 / (i + 1), {"split": "train"}), metric_buffer.close
+    elif name == "log_info":
+        return lambda i: update_job(job_id, {"state.step": i}, w=0), lambda: None
+    elif name == "heartbeat":
+        # The agent's writes are delayed, closing it writes out what it received
+        return lambda i: run.send_heartbeat(job_id, rank), heartbeat.close
+    else:
+        raise ValueError(f"Unknown workload {name}")
+
+
+def run_worker(workload, rank, n_workers, job_id, rate, duration, use_mongodb, output_dir, queue):
+    if use_mongodb:
+        db = connections.mongo
+    else:
+        db = connections._mongo_client = StandInDatabase()
+        # Each worker is a separate process, this doesn't leak into the others
+        for module in [run, heartbeat, job_queue]:
+            module.UpdateOne = stand_in_update_one
+
+    with open(os.path.join(output_dir, f"output.worker{rank}.txt"), "w") as log_file:
+        call, close = make_workload(workload, db, job_id, rank, n_workers, log_file)
+
+        histogram = LatencyHistogram()
+        start = perf_counter()
+        i = 0
+        while perf_counter() - start < duration:
+            if rate:
+                delay = start + i / rate - perf_counter()
+                if delay > 0:
+                    sleep(delay)
+            call_start = perf_counter()
+            call(i)
+            histogram.record(perf_counter() - call_start)
+            i += 1
+        elapsed = perf_counter() - start
+
+        drain_start = perf_counter()
+        close()
+        drain_time = perf_counter() - drain_start
+        file_bytes = log_file.tell()
+
+    queue.put(
+        {
+            "calls": i,
+            "elapsed": elapsed,
+            "drain_time": drain_time,
+            "histogram": histogram.to_document(),
+            "db_bytes": None if use_mongodb else db.bytes_written,
+            "file_bytes": file_bytes,
+        }
+    )
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("workloads", nargs="*", help=f"default: all of {', '.join(RATES)}")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--duration", type=float, default=5, help="seconds per measurement")
+    parser.add_argument(
+        "--unthrottled", default=False, action="store_true", help="call as fast as possible"
+    )
+    parser.add_argument("--mongodb", default=False, action="store_true")
+    parser.add_argument("--database", default="jobmonitor_benchmark", help="with --mongodb")
+    args = parser.parse_args()
+
+    if args.mongodb:
+        if args.database == os.getenv("JOBMONITOR_METADATA_DB"):
+            raise ValueError("The benchmark drops its database, don't use the real one.")
+        os.environ["JOBMONITOR_METADATA_DB"] = args.database
+        print(f"Writing to {args.database} on {os.getenv('JOBMONITOR_METADATA_HOST')}")
+    else:
+        print("Writing to an in-process stand-in for MongoDB")
+
+    context = multiprocessing.get_context("fork")
+    print(
+        f"{'workload':<11} {'workers':>7} {'rate/worker':>11} {'calls/s':>10} "
+        f"{'p50 (us)':>9} {'p99 (us)':>9} {'drain (s)':>9} {'DB (MB)':>8} {'files (MB)':>10}"
+    )
+    for workload in args.workloads or list(RATES):
+        rate = None if args.unthrottled else RATES[workload]
+        for n_workers in args.workers:
+            job_id = str(ObjectId())
+            if args.mongodb:
+                connections.mongo.job.insert_one({"_id": ObjectId(job_id), "n_workers": n_workers})
+                bytes_before = _server_bytes_in()
+
+            queue = context.Queue()
+            with tempfile.TemporaryDirectory() as output_dir:
+                # The workers get their own heartbeat agent, so heartbeats of real jobs on
+                # this node never reach the benchmark, and the benchmark's never reach theirs
+                heartbeat.SOCKET_PATH = os.path.join(output_dir, "heartbeat.sock")
+                os.environ["JOBMONITOR_HEARTBEAT_SOCKET"] = heartbeat.SOCKET_PATH
+                processes = [
+                    context.Process(
+                        target=run_worker,
+                        args=(
+                            workload,
+                            rank,
+                            n_workers,
+                            job_id,
+                            rate,
+                            args.duration,
+                            args.mongodb,
+                            output_dir,
+                            queue,
+                        ),
+                    )
+                    for rank in range(n_workers)
+                ]
+                for process in processes:
+                    process.start()
+                results = [queue.get() for _ in processes]
+                for process in processes:
+                    process.join()
+
+            histogram = LatencyHistogram()
+            for result in results:
+                histogram.merge(LatencyHistogram.from_document(result["histogram"]))
+            calls_per_second = sum(result["calls"] / result["elapsed"] for result in results)
+            drain_time = max(result["drain_time"] for result in results)
+            if args.mongodb:
+                # Includes the traffic of other clients of the server
+                db_bytes = _server_bytes_in() - bytes_before
+            else:
+                db_bytes = sum(result["db_bytes"] for result in results)
+            file_bytes = sum(result["file_bytes"] for result in results)
+
+            print(
+                f"{workload:<11} {n_workers:>7} {rate or 'max':>11} {calls_per_second:>10.0f} "
+                f"{1e6 * histogram.quantile(0.5):>9.1f} {1e6 * histogram.quantile(0.99):>9.1f} "
+                f"{drain_time:>9.3f} {db_bytes / 1e6:>8.2f} {file_bytes / 1e6:>10.2f}"
+            )
+
+    if args.mongodb:
+        connections.mongo.client.drop_database(args.database)
+
+
+def _server_bytes_in():
+    return connections.mongo.command("serverStatus")["network"]["bytesIn"]
+
+
+if __name__ == "__main__":
+    main()
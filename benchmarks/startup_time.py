@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+"""
+Measures how long it takes to import every console script listed in setup.py,
+with `python -X importtime`, and fails when one exceeds its startup budget
+or imports a heavy module that only some of its code paths need.
+
+    python benchmarks/startup_time.py
+    python benchmarks/startup_time.py --budget-scale 2  # on a slow machine
+"""
+
+import os
+import re
+import subprocess
+import sys
+from argparse import ArgumentParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Startup budget in milliseconds, on top of the bare interpreter startup
+DEFAULT_BUDGET_MS = 300
+BUDGET_MS = {
+    # Talks to MongoDB and runs user code, pymongo, yaml and multiprocessing are always needed
+    "jobrun": 600,
+}
+
+# Modules that no command may import before its code path needs them
+DEFERRED_MODULES = ["git", "kubernetes", "numpy", "pandas", "schema"]
+
+
+def console_scripts():
+    with open(os.path.join(ROOT, "setup.py")) as fp:
+        return re.findall(r'"([\w-]+)=([\w.]+):\w+"', fp.read())
+
+
+def import_times(statement):
+    """{module: self time in microseconds} for all modules imported by `statement`"""
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=ROOT,
+        stderr=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        universal_newlines=True,
+        check=True,
+    ).stderr
+    times = {}
+    for line in output.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+\d+ \|\s+(.*)$", line)
+        if match:
+            times[match.group(2).strip()] = int(match.group(1))
+    return times
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("commands", nargs="*", help="default: all console scripts")
+    parser.add_argument("--repeat", type=int, default=5, help="report the fastest of n runs")
+    parser.add_argument("--budget-scale", type=float, default=1.0, help="multiply all budgets")
+    parser.add_argument("--top", type=int, default=3, help="show the n slowest imports")
+    args = parser.parse_args()
+
+    baseline = set(import_times("pass"))
+
+    failures = []
+    print(f"{'command':<12} {'import (ms)':>11} {'budget':>7}  slowest imports")
+    for command, module in console_scripts():
+        if args.commands and command not in args.commands:
+            continue
+
+        runs = [import_times(f"import {module}") for _ in range(args.repeat)]
+        times = min(runs, key=lambda times: sum(times.values()))
+        # Modules that the interpreter imports anyway don't count
+        times = {name: t for name, t in times.items() if name not in baseline}
+        total_ms = sum(times.values()) / 1000
+
+        budget_ms = BUDGET_MS.get(command, DEFAULT_BUDGET_MS) * args.budget_scale
+        slowest = sorted(times, key=lambda name: -times[name])[: args.top]
+        print(
+            f"{command:<12} {total_ms:>11.1f} {budget_ms:>7.0f}  "
+            + ", ".join(f"{name} ({times[name] / 1000:.0f})" for name in slowest)
+        )
+
+        if total_ms > budget_ms:
+            failures.append(f"{command} takes {total_ms:.0f}ms to start, budget {budget_ms:.0f}ms")
+        deferred = sorted({name.split(".")[0] for name in times} & set(DEFERRED_MODULES))
+        if deferred:
+            failures.append(f"{command} imports {', '.join(deferred)} at startup")
+
+    if failures:
+        print()
+        for failure in failures:
+            print("FAIL", failure)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
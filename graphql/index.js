@@ -199,31 +199,48 @@ const resolvers = {
     Job: {
         logs: (job, args, context, info) => {
             return mongo
-                .collection("job")
-                .findOne({ _id: ObjectID(job.id) }, { projection: { logs: true } })
-                .then((jobdata) => {
-                    if (jobdata["logs"] != null) {
-                        // Read from the database
-                        return jobdata["logs"]
-                            .filter((j) => j.worker === 0)
-                            .map((j) => j.message)
-                            .join("\n");
-                    } else {
-                        // Read from a logfile
-                        if (job.outputDirectory == null) return null;
-                        const logFile = path.join(
-                            process.env.JOBMONITOR_RESULTS_DIR,
-                            job.outputDirectory,
-                            "output.txt"
-                        );
-                        if (!fs.existsSync(logFile)) return null;
-                        return new Promise((resolve, reject) =>
-                            fs.readFile(logFile, "utf8", (err, value) => {
-                                if (err) reject(err);
-                                resolve(value);
-                            })
-                        );
-                    }
+                .collection("log_bucket")
+                .find({ job_id: ObjectID(job.id), worker: 0 })
+                .project({ lines: true })
+                .toArray()
+                .then((buckets) => {
+                    if (buckets.length === 0) return null;
+                    // Buckets written concurrently by stdout and stderr can overlap in time
+                    return []
+                        .concat(...buckets.map((bucket) => bucket.lines))
+                        .sort((a, b) => a.time - b.time)
+                        .map((j) => j.message)
+                        .join("\n");
+                })
+                .then((logs) => {
+                    if (logs != null) return logs;
+                    return mongo
+                        .collection("job")
+                        .findOne({ _id: ObjectID(job.id) }, { projection: { logs: true } })
+                        .then((jobdata) => {
+                            if (jobdata["logs"] != null) {
+                                // Read from the job document (older jobs)
+                                return jobdata["logs"]
+                                    .filter((j) => j.worker === 0)
+                                    .map((j) => j.message)
+                                    .join("\n");
+                            } else {
+                                // Read from a logfile
+                                if (job.outputDirectory == null) return null;
+                                const logFile = path.join(
+                                    process.env.JOBMONITOR_RESULTS_DIR,
+                                    job.outputDirectory,
+                                    "output.txt"
+                                );
+                                if (!fs.existsSync(logFile)) return null;
+                                return new Promise((resolve, reject) =>
+                                    fs.readFile(logFile, "utf8", (err, value) => {
+                                        if (err) reject(err);
+                                        resolve(value);
+                                    })
+                                );
+                            }
+                        });
                 });
         },
         textFile: (job, args, context, info) => {
@@ -412,8 +429,13 @@ function statusQuery(status) {
     let statusSearch = {};
     const heartbeatThreshold = new Date(Date.now() - 2 * HEARTBEAT_INTERVAL * 1000);
     if (status === "UNRESPONSIVE") {
-        statusSearch["status"] = "RUNNING";
-        statusSearch["last_heartbeat_time"] = { $lte: heartbeatThreshold };
+        // Running without recent heartbeats, or marked as such by `jobreaper`
+        return {
+            $or: [
+                { status: "RUNNING", last_heartbeat_time: { $lte: heartbeatThreshold } },
+                { status: "UNRESPONSIVE" },
+            ],
+        };
     } else if (status === "RUNNING") {
         statusSearch["status"] = "RUNNING";
         statusSearch["last_heartbeat_time"] = { $gt: heartbeatThreshold };
@@ -538,14 +560,9 @@ function jobStatus(entry) {
 function getValueFromTimeseries(operator) {
     return (timeseries, args, context, info) => {
         const { measurement, jobId, id, tags } = timeseries;
-        const key = `metric_data.${id}`;
-        const projection = {};
-        projection[key] = true;
-        return mongo
-            .collection("job")
-            .findOne({ _id: ObjectID(jobId) }, { projection })
-            .then((jobdata) => {
-                const data = jobdata["metric_data"][id].map((e) => {
+        return getMetricData(jobId, id)
+            .then((values) => {
+                const data = values.map((e) => {
                     if (Object.keys(e).includes("time") && typeof e.time !== "number") {
                         return {
                             ...e,
@@ -580,6 +597,35 @@ function getValueFromTimeseries(operator) {
     };
 }
 
+/**
+ * Load all data points of a timeseries
+ *
+ * Points are stored in fixed-size documents in the `metric_bucket` collection.
+ * Jobs that were never migrated keep them in the `metric_data` field of the job document.
+ * @param {string} jobId
+ * @param {string} id
+ */
+function getMetricData(jobId, id) {
+    return mongo
+        .collection("metric_bucket")
+        .find({ job_id: ObjectID(jobId), series: id })
+        .project({ values: true })
+        .sort({ first_time: 1 })
+        .toArray()
+        .then((buckets) => {
+            if (buckets.length > 0) {
+                return [].concat(...buckets.map((bucket) => bucket.values));
+            }
+            const key = `metric_data.${id}`;
+            const projection = {};
+            projection[key] = true;
+            return mongo
+                .collection("job")
+                .findOne({ _id: ObjectID(jobId) }, { projection })
+                .then((jobdata) => (jobdata["metric_data"] || {})[id] || []);
+        });
+}
+
 const app = express();
 
 const server = new ApolloServer({ typeDefs, resolvers, cors: { origin: true } });
@@ -603,23 +649,38 @@ app.get("/file/:jobId*", function (req, res, next) {
         .catch((err) => next(err));
 });
 
-// HACKY MESS:
-if (!metadataHost.includes("//")) {
-    metadataHost = `mongodb://${metadataHost}`;
+let mongoUrl = process.env.JOBMONITOR_METADATA_URI;
+if (!mongoUrl) {
+    // HACKY MESS:
+    if (!metadataHost.includes("//")) {
+        metadataHost = `mongodb://${metadataHost}`;
+    }
+    mongoUrl = `${metadataHost}:${metadataPort}/${metadataDb}`;
+    if (metadataPassword != null) {
+        mongoUrl = mongoUrl.replace("://", `://${metadataUser}:${encodeURIComponent(metadataPassword)}@`);
+    }
+    if (metadataHost.includes("mongodb+srv")) {
+        mongoUrl = mongoUrl.replace(`:${metadataPort}`, "");
+    }
 }
-let mongoUrl = `${metadataHost}:${metadataPort}/${metadataDb}`;
-if (metadataPassword != null) {
-    mongoUrl = mongoUrl.replace("://", `://${metadataUser}:${encodeURIComponent(metadataPassword)}@`);
+// Same options as the Python client, e.g. maxPoolSize=20&compressors=zstd,snappy.
+// Reads can go to secondaries with JOBMONITOR_METADATA_READ_PREFERENCE, writes always use the primary.
+const mongoOptions = new URLSearchParams(process.env.JOBMONITOR_METADATA_OPTIONS || "");
+if (process.env.JOBMONITOR_METADATA_READ_PREFERENCE) {
+    mongoOptions.set("readPreference", process.env.JOBMONITOR_METADATA_READ_PREFERENCE);
 }
-if (metadataHost.includes("mongodb+srv")) {
-    mongoUrl = mongoUrl.replace(`:${metadataPort}`, "");
+if ([...mongoOptions].length > 0) {
+    const [base, query] = mongoUrl.split("?");
+    const options = new URLSearchParams(query || "");
+    mongoOptions.forEach((value, key) => options.set(key, value));
+    mongoUrl = `${base}${base.split("//")[1].includes("/") ? "" : "/"}?${options}`;
 }
 
 const tcpPort = parseInt(process.env.PORT, 10) || 4000;
 MongoClient.connect(mongoUrl, {
     useNewUrlParser: true,
 })
-    .then((db) => (mongo = db.db()))
+    .then((db) => (mongo = db.db(metadataDb)))
     .then(() => app.listen(tcpPort))
     .then(({ url }) => {
         console.log(`🚀 Server ready at port ${tcpPort}`);
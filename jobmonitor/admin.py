@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+
+"""
+Maintenance of the job monitor's MongoDB database.
+
+    jobmonitor-admin ensure-indexes   # create the indexes that the built-in queries need
+    jobmonitor-admin explain          # check that none of those queries scans a whole collection
+    jobmonitor-admin enqueue-waiting  # add jobs that wait for workers to the job queue
+"""
+
+import datetime
+import sys
+from argparse import ArgumentParser
+
+from bson.objectid import ObjectId
+
+from jobmonitor.api import LOG_BUCKET_INDEXES, METRIC_BUCKET_INDEX
+from jobmonitor.job_queue import MAX_ATTEMPTS
+from jobmonitor.lazy_loader import LazyLoader
+
+c = LazyLoader("c", globals(), "jobmonitor.connections")
+
+# {collection: [(keys, options)]}
+INDEXES = {
+    "job": [
+        # Job lists in GraphQL and joblist, newest first
+        ([("creation_time", -1)], {}),
+        ([("status", 1), ("creation_time", -1)], {}),
+        ([("user", 1), ("creation_time", -1)], {}),
+        ([("project", 1), ("experiment", 1), ("creation_time", -1)], {}),
+        # jobdelete, jobkill, jobstar, jobbug with --experiment/--status/--job
+        ([("experiment", 1), ("status", 1), ("job", 1)], {}),
+        # RUNNING and UNRESPONSIVE jobs by their last heartbeat. Only running jobs are indexed.
+        (
+            [("last_heartbeat_time", 1)],
+            {"name": "running_heartbeat", "partialFilterExpression": {"status": "RUNNING"}},
+        ),
+    ],
+    "job_queue": [
+        # Claiming a slot: not started, by priority and age, lease expired
+        (
+            [
+                ("started", 1),
+                ("priority", -1),
+                ("creation_time", 1),
+                ("rank", 1),
+                ("lease_expiry", 1),
+            ],
+            {"name": "claim"},
+        ),
+        ([("job_id", 1)], {}),
+    ],
+    "log_bucket": [(index, {}) for index in LOG_BUCKET_INDEXES],
+    "metric_bucket": [(METRIC_BUCKET_INDEX, {})],
+    "profile": [([("job_id", 1), ("worker", 1)], {})],
+    # Code packages are looked up by content hash. Tar packages don't have one.
+    "fs.files": [
+        (
+            [("metadata.contentHash", 1)],
+            {"partialFilterExpression": {"metadata.contentHash": {"$exists": True}}},
+        )
+    ],
+}
+
+_CLAIM_FILTER = {
+    "started": False,
+    "lease_expiry": {"$lt": datetime.datetime.utcnow()},
+    "attempts": {"$lt": MAX_ATTEMPTS},
+}
+_CLAIM_SORT = [("priority", -1), ("creation_time", 1), ("rank", 1)]
+
+# The queries of jobrun, the command-line tools and the GraphQL server:
+# (description, collection, filter, sort, limit). Values are placeholders.
+QUERY_SHAPES = [
+    ("jobrun --queue-mode any", "job_queue", _CLAIM_FILTER, _CLAIM_SORT, 1),
+    (
+        "jobrun --queue-mode <job ids>",
+        "job_queue",
+        {**_CLAIM_FILTER, "job_id": {"$in": [ObjectId(), ObjectId()]}},
+        _CLAIM_SORT,
+        1,
+    ),
+    (
+        "jobrun --queue-mode --min-worker-count",
+        "job_queue",
+        {**_CLAIM_FILTER, "n_workers": {"$gte": 2}},
+        _CLAIM_SORT,
+        1,
+    ),
+    ("end of a job", "job_queue", {"job_id": ObjectId()}, None, 0),
+    ("jobdelete --status", "job", {"status": "FINISHED"}, None, 0),
+    (
+        "jobdelete --experiment --job --status",
+        "job",
+        {"experiment": "experiment", "job": {"$regex": "job"}, "status": "FINISHED"},
+        None,
+        0,
+    ),
+    ("GraphQL jobs", "job", {}, [("creation_time", -1)], 50),
+    (
+        "GraphQL jobs(project, experiment)",
+        "job",
+        {"project": "project", "experiment": "experiment"},
+        [("creation_time", -1)],
+        0,
+    ),
+    (
+        "GraphQL jobs(status: UNRESPONSIVE)",
+        "job",
+        {"status": "RUNNING", "last_heartbeat_time": {"$lte": datetime.datetime.utcnow()}},
+        [("creation_time", -1)],
+        0,
+    ),
+    ("joblist --user", "job", {"user": "user"}, [("creation_time", -1)], 0),
+    ("job logs of a worker", "log_bucket", {"job_id": ObjectId(), "worker": 0}, None, 0),
+    (
+        "metric series",
+        "metric_bucket",
+        {"job_id": ObjectId(), "series": "series"},
+        [("first_time", 1)],
+        0,
+    ),
+    ("jobprofile", "profile", {"job_id": ObjectId()}, [("worker", 1)], 0),
+    ("code package by content hash", "fs.files", {"metadata.contentHash": "hash"}, None, 1),
+]
+
+
+def ensure_indexes(collections=None, dry_run=False):
+    """
+    Create missing indexes. Returns the indexes that could not be created,
+    or that exist with other options.
+    """
+    from pymongo.errors import OperationFailure
+
+    failed = []
+    for collection, indexes in INDEXES.items():
+        if collections is not None and collection not in collections:
+            continue
+        existing = {}
+        for index in c.mongo[collection].list_indexes():
+            existing.setdefault(tuple(index["key"].items()), []).append(index)
+        for keys, options in indexes:
+            description = f"{collection} {_format_keys(keys)}"
+            if options.get("partialFilterExpression"):
+                description += f" where {options['partialFilterExpression']}"
+            if tuple(keys) in existing:
+                if any(_same_options(index, options) for index in existing[tuple(keys)]):
+                    print(f"exists    {description}")
+                else:
+                    # Needs to be dropped and created again, which can take long on a big collection
+                    found = ", ".join(
+                        str(_index_options(index)) for index in existing[tuple(keys)]
+                    )
+                    print(f"DIFFERENT {description}: exists with options {found}")
+                    failed.append(description)
+                continue
+            if dry_run:
+                print(f"missing   {description}")
+                continue
+            try:
+                c.mongo[collection].create_index(keys, **options)
+                print(f"created   {description}")
+            except OperationFailure as e:
+                # E.g. an index with the same name or keys but other options
+                print(f"FAILED    {description}: {e}")
+                failed.append(description)
+    return failed
+
+
+def explain_queries():
+    """Print the plan of every built-in query shape. Returns those that scan a collection."""
+    collection_scans = []
+    for description, collection, filter, sort, limit in QUERY_SHAPES:
+        cursor = c.mongo[collection].find(filter).limit(limit)
+        if sort is not None:
+            cursor = cursor.sort(sort)
+        stages, index_names = _plan_stages(cursor.explain()["queryPlanner"]["winningPlan"])
+        if "COLLSCAN" in stages:
+            result = "COLLSCAN"
+            collection_scans.append(description)
+        elif index_names:
+            result = "index " + ", ".join(sorted(index_names))
+        else:
+            # E.g. EOF when the collection doesn't exist yet
+            result = "+".join(sorted(stages))
+        if sort is not None and "SORT" in stages:
+            result += " (sorts in memory)"
+        print(f"{description:<40} {result}")
+    return collection_scans
+
+
+def _plan_stages(plan):
+    """All stage names and index names in a (possibly nested or sharded) query plan"""
+    stages = set()
+    index_names = set()
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.add(plan["stage"])
+        if "indexName" in plan:
+            index_names.add(plan["indexName"])
+        children = plan.values()
+    elif isinstance(plan, list):
+        children = plan
+    else:
+        children = []
+    for child in children:
+        child_stages, child_index_names = _plan_stages(child)
+        stages |= child_stages
+        index_names |= child_index_names
+    return stages, index_names
+
+
+# Index options that change which documents an index holds or what it does with them
+_COMPARED_OPTIONS = ["unique", "sparse", "partialFilterExpression", "expireAfterSeconds"]
+
+
+def _index_options(index):
+    return {option: index[option] for option in _COMPARED_OPTIONS if option in index}
+
+
+def _same_options(index, options):
+    wanted = {option: options[option] for option in _COMPARED_OPTIONS if option in options}
+    # The server only reports `unique` and `sparse` when they are set
+    existing = {option: value for option, value in _index_options(index).items() if value}
+    return existing == {option: value for option, value in wanted.items() if value}
+
+
+def _format_keys(keys):
+    return "(" + ", ".join(f"{field} {direction}" for field, direction in keys) + ")"
+
+
+def main():
+    parser = ArgumentParser()
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    ensure_parser = commands.add_parser(
+        "ensure-indexes", help="Create the indexes that the built-in queries need."
+    )
+    ensure_parser.add_argument(
+        "--dry-run", default=False, action="store_true", help="only list missing indexes"
+    )
+    ensure_parser.add_argument("collections", nargs="*", help=f"default: {', '.join(INDEXES)}")
+
+    commands.add_parser("explain", help="Report built-in queries that scan a whole collection.")
+    commands.add_parser(
+        "enqueue-waiting",
+        help="Add CREATED and SCHEDULED jobs without workers that are missing from the job queue.",
+    )
+
+    args = parser.parse_args()
+
+    if args.command == "ensure-indexes":
+        unknown = set(args.collections) - set(INDEXES)
+        if unknown:
+            parser.error(f"No indexes are defined for {', '.join(sorted(unknown))}")
+        if ensure_indexes(args.collections or None, dry_run=args.dry_run):
+            sys.exit(1)
+    elif args.command == "explain":
+        collection_scans = explain_queries()
+        if collection_scans:
+            print()
+            print(f"{len(collection_scans)} queries scan a whole collection.")
+            print("Run `jobmonitor-admin ensure-indexes` to create the missing indexes.")
+            sys.exit(1)
+    elif args.command == "enqueue-waiting":
+        from jobmonitor.job_queue import enqueue_waiting_jobs
+
+        print(f"Added {enqueue_waiting_jobs()} jobs to the queue.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,28 @@
 import datetime
+import hashlib
+import io
+import json
 import os
 import random
+import shutil
 import string
-import tarfile
-from collections import namedtuple
+import time
+from collections import OrderedDict, namedtuple
 from collections.abc import Iterable
 from fnmatch import fnmatch
-from tempfile import NamedTemporaryFile
+from tempfile import TemporaryFile
 from typing import List
 
+from bson.binary import Binary
 from bson.objectid import ObjectId
-from git import InvalidGitRepositoryError, Repo
-from schema import Or, Schema
+from pymongo.errors import DuplicateKeyError, OperationFailure
 
+from jobmonitor import job_queue
+from jobmonitor.compression import CODECS, CompressedWriter, DecompressedReader
+from jobmonitor.compression import compressor as make_compressor
+from jobmonitor.compression import decompressor as make_decompressor
 from jobmonitor.lazy_loader import LazyLoader
+from jobmonitor.utils import file_sha256
 
 kubernetes_client = LazyLoader("k", globals(), "kubernetes.client")
 kubernetes = LazyLoader("kubernetes", globals(), "kubernetes")
@@ -22,6 +31,24 @@ KUBERNETES_NAMESPACE = LazyLoader(
 )
 c = LazyLoader("c", globals(), "jobmonitor.connections")
 
+# Metric data points are stored outside of the job document,
+# in the collection `metric_bucket`, with at most this many points per document.
+METRIC_BUCKET_SIZE = 1000
+METRIC_BUCKET_INDEX = [("job_id", 1), ("series", 1), ("first_time", 1)]
+
+# Log lines are stored in the collection `log_bucket`, per job and worker,
+# with at most this many lines per document.
+LOG_BUCKET_SIZE = 1000
+LOG_BUCKET_INDEXES = [
+    [("job_id", 1), ("worker", 1), ("last_time", 1)],
+    [("job_id", 1), ("last_time", 1)],
+]
+
+# Files in code packages are stored once per content hash in the collection `code_blob`,
+# compressed, and so are the packages' manifests. Larger files are split into parts of
+# at most this many bytes.
+CODE_BLOB_PART_SIZE = 8 * 1024 * 1024
+
 
 def job_by_id(job_id):
     return c.mongo.job.find_one(
@@ -30,7 +57,16 @@ def job_by_id(job_id):
 
 
 def delete_job_by_id(job_id):
-    return c.mongo.job.delete_one({"_id": ObjectId(job_id)})
+    return delete_jobs_by_id([job_id])
+
+
+def delete_jobs_by_id(job_ids):
+    job_ids = {"$in": [ObjectId(job_id) for job_id in job_ids]}
+    c.mongo.metric_bucket.delete_many({"job_id": job_ids})
+    c.mongo.log_bucket.delete_many({"job_id": job_ids})
+    c.mongo.profile.delete_many({"job_id": job_ids})
+    c.mongo.job_queue.delete_many({"job_id": job_ids})
+    return c.mongo.job.delete_many({"_id": job_ids})
 
 
 def update_job(job_id, update_dict, w=None):
@@ -38,6 +74,193 @@ def update_job(job_id, update_dict, w=None):
     return c.mongo.job.update({"_id": ObjectId(job_id)}, {"$set": update_dict}, w=w)
 
 
+def metric_series(job_id, series_id):
+    """
+    Iterate over the data points of a timeseries in chronological order.
+    Buckets are streamed from the `metric_bucket` collection one batch at a time.
+    Jobs that were never migrated fall back to their `metric_data` field.
+    """
+    buckets = c.mongo.metric_bucket.find(
+        {"job_id": ObjectId(job_id), "series": series_id},
+        {"values": 1},
+        sort=[("first_time", 1)],
+        batch_size=10,
+    )
+    found_buckets = False
+    for bucket in buckets:
+        found_buckets = True
+        yield from bucket["values"]
+
+    if not found_buckets:
+        job = c.mongo.job.find_one({"_id": ObjectId(job_id)}, {f"metric_data.{series_id}": 1})
+        if job is not None:
+            yield from job.get("metric_data", {}).get(series_id, [])
+
+
+def job_logs(job_id, worker=None, tail=None):
+    """
+    Log lines of a job in chronological order, optionally only of one worker.
+    With `tail`, only the last lines are returned, and only the buckets
+    that contain them are fetched from the database.
+    Jobs that were logging to their `logs` field are still supported.
+    :return list of {worker, type, message, time} or None if the job does not exist
+    """
+    query = {"job_id": ObjectId(job_id)}
+    if worker is not None:
+        query["worker"] = worker
+    buckets = c.mongo.log_bucket.find(
+        query, {"lines": 1, "last_time": 1}, sort=[("last_time", -1)], batch_size=10
+    )
+
+    lines = []
+    found_buckets = False
+    for bucket in buckets:
+        found_buckets = True
+        if tail is not None:
+            # Buckets are visited newest first. Once we have enough lines that are newer
+            # than anything in this bucket, older buckets cannot contribute to the tail.
+            if sum(1 for line in lines if line["time"] > bucket["last_time"]) >= tail:
+                break
+        lines.extend(bucket["lines"])
+
+    if not found_buckets:
+        if tail is not None and worker is None:
+            # A projection with only $slice would return all other fields too
+            projection = {"status": 1, "logs": {"$slice": -tail}}
+        else:
+            projection = {"logs": 1}
+        job = c.mongo.job.find_one({"_id": ObjectId(job_id)}, projection)
+        if job is None:
+            return None
+        lines = job.get("logs", [])
+        if worker is not None:
+            lines = [line for line in lines if line["worker"] == worker]
+
+    lines.sort(key=lambda line: line["time"])
+    if tail is not None:
+        lines = lines[max(len(lines) - tail, 0) :]
+    return lines
+
+
+def follow_job_logs(job_id, worker=None, since=None, poll_interval=1.0):
+    """
+    Yield log lines of a job as they are written, forever.
+    Lines of buckets that are still being filled and that are newer than `since` are yielded first.
+    Uses a change stream on `log_bucket`, and falls back to polling on standalone servers,
+    which don't support change streams. Only line counts of recent buckets are kept in memory.
+    """
+    job = c.mongo.job.find_one({"_id": ObjectId(job_id)}, {"status": 1, "logs": {"$slice": -1}})
+    if job is not None and "logs" in job:
+        yield from _follow_job_document_logs(job_id, worker, since, poll_interval)
+        return
+
+    query = {"job_id": ObjectId(job_id)}
+    if worker is not None:
+        query["worker"] = worker
+    # bucket _id -> number of lines already yielded, for the most recently changed buckets
+    seen = OrderedDict()
+
+    def new_lines(bucket):
+        n_seen = seen.pop(bucket["_id"], 0)
+        lines = bucket["lines"][n_seen:]
+        seen[bucket["_id"]] = n_seen + len(lines)
+        while len(seen) > 1000:
+            seen.popitem(last=False)
+        return lines
+
+    def catch_up():
+        open_buckets = {"count": {"$lt": LOG_BUCKET_SIZE}}
+        if since is not None:
+            open_buckets = {"$or": [open_buckets, {"last_time": {"$gt": since}}]}
+        for bucket in c.mongo.log_bucket.find({**query, **open_buckets}):
+            for line in new_lines(bucket):
+                if since is not None and line["time"] > since:
+                    yield line
+
+    pipeline = [
+        {
+            "$match": {
+                "operationType": {"$in": ["insert", "update", "replace"]},
+                **{"fullDocument." + key: value for key, value in query.items()},
+            }
+        }
+    ]
+    try:
+        stream = c.mongo.log_bucket.watch(pipeline, full_document="updateLookup")
+    except OperationFailure:
+        stream = None
+
+    if stream is not None:
+        with stream:
+            # The stream is already open, so nothing gets lost while catching up
+            yield from catch_up()
+            for change in stream:
+                if change.get("fullDocument") is not None:
+                    yield from new_lines(change["fullDocument"])
+        return
+
+    # Polling: fetch line counts of active buckets, and then only the lines that are new.
+    # Buckets can be created and filled between two polls, so newer buckets are fetched too.
+    # Polling servers are standalone, where bucket ids increase with their creation.
+    newest = c.mongo.log_bucket.find_one(query, {"_id": 1}, sort=[("_id", -1)])
+    newest_id = newest["_id"] if newest is not None else ObjectId("0" * 24)
+    yield from catch_up()
+    while True:
+        time.sleep(poll_interval)
+        active_buckets = {
+            "$or": [
+                {"count": {"$lt": LOG_BUCKET_SIZE}},
+                {"_id": {"$in": list(seen)}},
+                {"_id": {"$gt": newest_id}},
+            ]
+        }
+        buckets = c.mongo.log_bucket.find({**query, **active_buckets}, {"count": 1}).sort("_id", 1)
+        for bucket in list(buckets):
+            newest_id = max(newest_id, bucket["_id"])
+            n_seen = seen.get(bucket["_id"], 0)
+            if bucket["count"] <= n_seen:
+                continue
+            bucket = c.mongo.log_bucket.find_one(
+                {"_id": bucket["_id"]},
+                {"count": 1, "lines": {"$slice": [n_seen, bucket["count"] - n_seen]}},
+            )
+            seen[bucket["_id"]] = n_seen + len(bucket["lines"])
+            yield from bucket["lines"]
+        # Forget buckets that are full and completely read
+        for bucket_id, n_seen in list(seen.items()):
+            if n_seen >= LOG_BUCKET_SIZE:
+                del seen[bucket_id]
+
+
+def _follow_job_document_logs(job_id, worker, since, poll_interval):
+    """Follow jobs that write to the `logs` field of their job document, with $slice polling"""
+    query = {"_id": ObjectId(job_id)}
+    sizes = c.mongo.job.aggregate(
+        [{"$match": query}, {"$project": {"size": {"$size": {"$ifNull": ["$logs", []]}}}}]
+    )
+    n_seen = next(sizes, {"size": 0})["size"]
+    if since is not None:
+        # Look back a little for lines written after `since`
+        n_seen = max(n_seen - 100, 0)
+
+    while True:
+        job = c.mongo.job.find_one(
+            query, {"status": 1, "logs": {"$slice": [n_seen, LOG_BUCKET_SIZE]}}
+        )
+        if job is None:
+            return
+        lines = job.get("logs", [])
+        n_seen += len(lines)
+        for line in lines:
+            if worker is not None and line["worker"] != worker:
+                continue
+            if since is not None and line["time"] <= since:
+                continue
+            yield line
+        if len(lines) < LOG_BUCKET_SIZE:
+            time.sleep(poll_interval)
+
+
 def register_job(
     project,
     experiment,
@@ -53,13 +276,21 @@ def register_job(
         user = os.getenv("USER")
 
     # Validate the inputs
+    from schema import Optional, Or, Schema
+
     Schema(str).validate(user)
     Schema(str).validate(project)
     Schema(str).validate(experiment)
     Schema(str).validate(job)
     Schema(Or({}, {str: object})).validate(config_overrides)
     Schema(Or(None, {str: object})).validate(annotations)
-    Schema({"clone": Or({"code_package": ObjectId}, {"path": str}), "script": str}).validate(
+    Schema(
+        {
+            "clone": Or({"code_package": ObjectId}, {"path": str}),
+            "script": str,
+            Optional("profile"): bool,
+        }
+    ).validate(
         runtime_environment
     )
 
@@ -82,6 +313,7 @@ def register_job(
 
     insert_result = c.mongo.job.insert_one(job_content)
     job_id = str(insert_result.inserted_id)
+    job_queue.enqueue_job(job_id, n_workers, priority, job_content["creation_time"])
     return job_id
 
 
@@ -167,8 +399,9 @@ def kubernetes_schedule_job_queue(
     random_id = "".join(random.choice(string.ascii_lowercase + string.digits) for _ in range(6))
     job_name = "{}-queue-{}".format(os.getenv("USER"), random_id)
     metadata = k.V1ObjectMeta(name=job_name, labels=dict(app="jobmonitor", user=os.getenv("USER")))
+    # Workers keep taking jobs from the queue and exit once it stayed empty for a minute
     pod_spec = kubernetes_create_base_pod_spec(
-        cmd=["jobrun", "--queue-mode", *job_ids],
+        cmd=["jobrun", "--queue-mode", "--max-idle-time", "60", *job_ids],
         docker_image_path=docker_image_path,
         gpus=gpus,
         environment_variables={"JOBMONITOR_RESULTS_DIR": results_dir, **environment_variables},
@@ -178,8 +411,9 @@ def kubernetes_schedule_job_queue(
         metadata=metadata,
         spec=k.V1JobSpec(
             backoff_limit=0,
-            completions=len(job_ids),
-            parallelism=parallelism,
+            # Work queue: no fixed number of completions, done when the workers exit
+            completions=None,
+            parallelism=min(parallelism, len(job_ids)),
             template=k.V1PodTemplateSpec(metadata=metadata, spec=pod_spec),
         ),
     )
@@ -232,6 +466,8 @@ def result_dir(job):
 
 
 def describe_git_state(directory):
+    from git import InvalidGitRepositoryError, Repo
+
     try:
         repo = Repo(directory)
         is_dirty = repo.is_dirty()
@@ -251,12 +487,26 @@ def describe_git_state(directory):
         return None, None, None, None, None, None
 
 
-def upload_code_package(directory=".", excludes=None):
+def upload_code_package(directory=".", excludes=None, format="blobs", compression="gzip"):
     """
-    Uploads a compressed tar file with directory contents to mongodb (gridfs).
+    Uploads the contents of a directory to mongodb (gridfs).
     This package can be used in a job specification.
+
+    With format="blobs", every file is stored once by its content hash (see `code_blob`)
+    and only files the server doesn't have yet are uploaded. The package itself is
+    a manifest that refers to these files. If a package with exactly the same contents
+    exists already, that package is returned and nothing is uploaded.
+    With format="tar", the package is a compressed tar file.
+    Both formats store a manifest of the package's files as a blob, and its hash in the metadata
+    (see `code_package_manifest`). Manifests of big directories don't fit in the metadata.
+
+    `compression` is one of jobmonitor.compression.CODECS. It is recorded with the package,
+    so downloads pick the right decoder.
     :return (1) ObjectId of the inserted file, (2) list of included files
     """
+    if compression not in CODECS:
+        raise ValueError(f"Unknown compression codec {compression}. Options: {CODECS}")
+
     included_files = []
 
     # Make a function used to select/exclude files for the package
@@ -282,32 +532,348 @@ def upload_code_package(directory=".", excludes=None):
         "gitCommitMessage": commit_message,
         "gitRepository": remote,
         "gitWasDirty": is_dirty,
+        "compression": compression,
     }
-
-    try:
-        # Create a temporary tar file
-        tmp = NamedTemporaryFile("rb")
-        with tarfile.open(tmp.name, "w:gz") as fp:
-            fp.add(directory, recursive=True, filter=filter_fn)
+    manifest = _directory_manifest(directory, excludes)
+
+    if format == "blobs":
+        return _upload_blob_package(directory, manifest, directory_basename, metadata)
+    elif format != "tar":
+        raise ValueError(f"Unknown code package format {format}")
+
+    metadata["format"] = "tar"
+    metadata["manifestBlob"] = _upload_manifest(manifest, compression)
+    extension = {"gzip": ".tgz", "zstd": ".tar.zst", "lz4": ".tar.lz4", "none": ".tar"}
+    with TemporaryFile() as tmp:
+        write_tar_package(directory, tmp, compression, filter=filter_fn)
+        tmp.seek(0)
         # Upload it to MongoDB
-        gridfs_id = c.gridfs.put(tmp, filename=directory_basename + ".tgz", metadata=metadata)
+        filename = directory_basename + extension[compression]
+        gridfs_id = c.gridfs.put(tmp, filename=filename, metadata=metadata)
         return gridfs_id, included_files
-    finally:
-        tmp.close()
 
 
-def download_code_package(package_id, destination):
+def download_code_package(package_id, destination, paths=None):
+    """
+    Extracts a code package while it is being downloaded.
+    The GridFS chunks are piped straight into the decompressor, so memory use stays bounded.
+    If `paths` is given, only these files (relative to the package root) are extracted.
+    """
     if type(package_id) == str:
         package_id = ObjectId(package_id)
+    with c.gridfs.get(package_id) as fp:
+        metadata = fp.metadata or {}
+        if metadata.get("format") == "blobs":
+            manifest = _package_manifest(metadata)
+            if paths is not None:
+                manifest = [entry for entry in manifest if entry["path"] in paths]
+            _download_blob_package(manifest, destination)
+        else:
+            # Packages without a recorded codec are gzipped tar files
+            extract_tar_package(fp, destination, metadata.get("compression", "gzip"), paths)
+
+
+def code_package_manifest(package_id):
+    """
+    List of {path, size, mode, sha256} for files, {path, link} for symlinks and
+    {path, directory} for empty directories in a code package, without downloading the package.
+    None if the package doesn't exist or was uploaded without a manifest.
+    """
+    if type(package_id) == str:
+        package_id = ObjectId(package_id)
+    file = c.mongo.fs.files.find_one(
+        {"_id": package_id}, {"metadata.manifest": 1, "metadata.manifestBlob": 1}
+    )
+    if file is None:
+        return None
+    return _package_manifest(file.get("metadata") or {})
+
+
+def _package_manifest(metadata):
+    if "manifestBlob" in metadata:
+        return json.loads(_read_blob(metadata["manifestBlob"]).decode("utf-8"))
+    # Older packages have their manifest in the metadata
+    return metadata.get("manifest")
+
+
+def diff_manifests(old_manifest, new_manifest):
+    """Sorted list of (change, path), where change is "added", "removed" or "modified"."""
+    old_entries = {entry["path"]: entry for entry in old_manifest}
+    new_entries = {entry["path"]: entry for entry in new_manifest}
+    changes = []
+    for path in sorted(set(old_entries) | set(new_entries)):
+        if path not in old_entries:
+            changes.append(("added", path))
+        elif path not in new_entries:
+            changes.append(("removed", path))
+        elif old_entries[path] != new_entries[path]:
+            changes.append(("modified", path))
+    return changes
+
+
+def write_tar_package(directory, fileobj, compression="gzip", filter=None):
+    """
+    Write a directory as a tar stream, compressed with one of jobmonitor.compression.CODECS.
+    Paths in the archive are relative to `directory`, like in the package manifest.
+    """
+    import tarfile
+
+    if compression == "gzip":
+        with tarfile.open(fileobj=fileobj, mode="w:gz") as tar:
+            tar.add(directory, arcname=".", recursive=True, filter=filter)
+        return
+    writer = CompressedWriter(fileobj, compression)
+    with tarfile.open(fileobj=writer, mode="w|") as tar:
+        tar.add(directory, arcname=".", recursive=True, filter=filter)
+    writer.close()
+
+
+def extract_tar_package(fileobj, destination, compression="gzip", paths=None):
+    """Extract a tar stream written by `write_tar_package` without seeking, optionally only `paths`"""
+    import tarfile
+
+    if compression in ["gzip", "none"]:
+        reader = fileobj  # tarfile handles these by itself
+    else:
+        reader = DecompressedReader(fileobj, compression)
+    with tarfile.open(fileobj=reader, mode="r|*") as tar:
+        if paths is None:
+            tar.extractall(destination)
+            return
+        for member in tar:
+            if os.path.normpath(member.name) in paths:
+                tar.extract(member, destination)
+
+
+def _directory_manifest(directory, excludes):
+    """
+    {path, size, mode, sha256} for every file, {path, link} for every symlink
+    and {path, directory} for every empty directory in a package
+    """
+    manifest = []
+    for path in _walk_package_directory(directory, excludes):
+        relative_path = os.path.relpath(path, directory)
+        if os.path.islink(path):
+            manifest.append({"path": relative_path, "link": os.readlink(path)})
+        elif os.path.isdir(path):
+            manifest.append({"path": relative_path, "directory": True})
+        else:
+            manifest.append(
+                {
+                    "path": relative_path,
+                    "size": os.path.getsize(path),
+                    "mode": os.stat(path).st_mode & 0o777,
+                    "sha256": file_sha256(path),
+                }
+            )
+    return manifest
+
+
+def _upload_blob_package(directory, manifest, directory_basename, metadata):
+    content_hash = _manifest_hash(manifest)
+    included_files = [entry["path"] for entry in manifest]
+
+    # Reuse a package with exactly the same contents
+    existing = c.mongo.fs.files.find_one({"metadata.contentHash": content_hash}, {"_id": 1})
+    if existing is not None:
+        return existing["_id"], included_files
+
+    # Upload the files that the server doesn't have yet
+    paths_by_hash = {entry["sha256"]: entry["path"] for entry in manifest if "sha256" in entry}
+    hashes = list(paths_by_hash)
+    for start in range(0, len(hashes), 1000):
+        batch = hashes[start : start + 1000]
+        present = {blob["_id"] for blob in c.mongo.code_blob.find({"_id": {"$in": batch}}, {})}
+        for sha256 in batch:
+            if sha256 not in present:
+                with open(os.path.join(directory, paths_by_hash[sha256]), "rb") as fp:
+                    _upload_blob(fp, sha256, metadata["compression"])
+
+    metadata = {
+        **metadata,
+        "format": "blobs",
+        "contentHash": content_hash,
+        "manifestBlob": _upload_manifest(manifest, metadata["compression"]),
+    }
+    gridfs_id = c.gridfs.put(b"", filename=directory_basename + ".manifest", metadata=metadata)
+    return gridfs_id, included_files
+
+
+def _manifest_hash(manifest):
+    return hashlib.sha256(_encode_manifest(manifest)).hexdigest()
+
+
+def _encode_manifest(manifest):
+    return json.dumps(manifest, sort_keys=True).encode("utf-8")
+
+
+def _upload_manifest(manifest, compression="gzip"):
+    """Store a manifest as a blob, returns its hash"""
+    data = _encode_manifest(manifest)
+    sha256 = hashlib.sha256(data).hexdigest()
+    if c.mongo.code_blob.find_one({"_id": sha256}, {}) is None:
+        _upload_blob(io.BytesIO(data), sha256, compression)
+    return sha256
+
+
+def _walk_package_directory(directory, excludes):
+    """
+    All files, symlinks and empty directories in a directory,
+    except those whose (directory) name is excluded
+    """
+    is_excluded = lambda name: any(fnmatch(name, pattern) for pattern in excludes)
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in list(dirs):
+            if is_excluded(name):
+                dirs.remove(name)
+            elif os.path.islink(os.path.join(root, name)):
+                # os.walk doesn't follow symlinked directories, store them as links
+                yield os.path.join(root, name)
+        files = [name for name in sorted(files) if not is_excluded(name)]
+        if not dirs and not files and root != directory:
+            # Jobs may expect the directory to exist, e.g. for their outputs
+            yield root
+        for name in files:
+            yield os.path.join(root, name)
+
+
+def _upload_blob(fileobj, sha256, compression="gzip"):
+    """
+    Store a file as {_id: sha256, data} or, if it is large, as parts {_id: sha256.upload.i, data}
+    followed by {_id: sha256, upload, parts}. The head document is written last, so blobs that
+    exist are complete. Parts are named after their upload, so a head never refers to parts of
+    another upload that was interrupted. Blobs are immutable, the first complete upload wins.
+    The head records the codec, blobs without one are zlib-compressed.
+    Raises RuntimeError and stores nothing if the contents don't match `sha256`, e.g. because
+    the file changed after it was hashed.
+    """
+    upload = str(ObjectId())
+    content_hash = hashlib.sha256()
+    part_ids = []
+    stored = False
     try:
-        tmp = NamedTemporaryFile("wb+")
-        with c.gridfs.get(package_id) as fp:
-            tmp.write(fp.read())
-        tmp.seek(0)
-        with tarfile.open(tmp.name, "r") as fp:
-            fp.extractall(destination)
+        previous_part = None
+        for part in _compressed_parts(fileobj, compression, content_hash):
+            if previous_part is not None:
+                part_ids.append(f"{sha256}.{upload}.{len(part_ids)}")
+                c.mongo.code_blob.insert_one({"_id": part_ids[-1], "data": Binary(previous_part)})
+            previous_part = part
+
+        if content_hash.hexdigest() != sha256:
+            name = getattr(fileobj, "name", sha256)
+            raise RuntimeError(f"{name} changed while it was uploaded. Try again.")
+
+        if not part_ids:
+            head = {"_id": sha256, "data": Binary(previous_part), "compression": compression}
+        else:
+            part_ids.append(f"{sha256}.{upload}.{len(part_ids)}")
+            c.mongo.code_blob.insert_one({"_id": part_ids[-1], "data": Binary(previous_part)})
+            head = {
+                "_id": sha256,
+                "upload": upload,
+                "parts": len(part_ids),
+                "compression": compression,
+            }
+        try:
+            c.mongo.code_blob.insert_one(head)
+            stored = True
+        except DuplicateKeyError:
+            # Another upload of the same contents finished first
+            pass
     finally:
-        tmp.close()
+        if not stored and part_ids:
+            c.mongo.code_blob.delete_many({"_id": {"$in": part_ids}})
+
+
+def _compressed_parts(fileobj, compression, content_hash):
+    """
+    Compressed contents of a binary file, in parts of at most CODE_BLOB_PART_SIZE bytes.
+    Updates the hashlib object `content_hash` with the uncompressed contents.
+    """
+    compressor = make_compressor(compression)
+    pending = b""
+    for block in iter(lambda: fileobj.read(1024 * 1024), b""):
+        content_hash.update(block)
+        pending += compressor.compress(block)
+        while len(pending) > CODE_BLOB_PART_SIZE:
+            yield pending[:CODE_BLOB_PART_SIZE]
+            pending = pending[CODE_BLOB_PART_SIZE:]
+    pending += compressor.flush()
+    while len(pending) > CODE_BLOB_PART_SIZE:
+        yield pending[:CODE_BLOB_PART_SIZE]
+        pending = pending[CODE_BLOB_PART_SIZE:]
+    yield pending
+
+
+def _read_blob(sha256):
+    blob = c.mongo.code_blob.find_one({"_id": sha256})
+    if blob is None:
+        raise RuntimeError(f"Blob {sha256} is missing from the database.")
+    data = b"".join(_decompressed_blob(blob))
+    if hashlib.sha256(data).hexdigest() != sha256:
+        raise RuntimeError(f"Blob {sha256} is corrupt.")
+    return data
+
+
+def blob_part_ids(blob):
+    """Ids of the parts of a blob, given its head document"""
+    if "parts" not in blob:
+        return []
+    if "upload" in blob:
+        return [f"{blob['_id']}.{blob['upload']}.{i}" for i in range(blob["parts"])]
+    # Blobs from before parts were named after their upload
+    return [f"{blob['_id']}.{i}" for i in range(blob["parts"])]
+
+
+def _decompressed_blob(blob):
+    """The contents of a blob in pieces, given its head document"""
+    decompressor = make_decompressor(blob.get("compression", "gzip"))
+    if "parts" not in blob:
+        yield decompressor.decompress(blob["data"])
+    for part_id in blob_part_ids(blob):
+        part = c.mongo.code_blob.find_one({"_id": part_id})
+        if part is None:
+            raise RuntimeError(f"Part {part_id} of a blob is missing from the database.")
+        yield decompressor.decompress(part["data"])
+    yield decompressor.flush()
+
+
+def _download_blob_package(manifest, destination):
+    paths_by_hash = {}
+    for entry in manifest:
+        path = os.path.join(destination, entry["path"])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.lexists(path) and not os.path.isdir(path):
+            os.remove(path)
+        if "directory" in entry:
+            os.makedirs(path, exist_ok=True)
+        elif "link" in entry:
+            os.symlink(entry["link"], path)
+        else:
+            paths_by_hash.setdefault(entry["sha256"], []).append(path)
+
+    hashes = list(paths_by_hash)
+    n_found = 0
+    for start in range(0, len(hashes), 1000):
+        for blob in c.mongo.code_blob.find({"_id": {"$in": hashes[start : start + 1000]}}):
+            n_found += 1
+            first_path, *other_paths = paths_by_hash[blob["_id"]]
+            content_hash = hashlib.sha256()
+            with open(first_path, "wb") as fp:
+                for data in _decompressed_blob(blob):
+                    content_hash.update(data)
+                    fp.write(data)
+            if content_hash.hexdigest() != blob["_id"]:
+                raise RuntimeError(f"Blob {blob['_id']} of {first_path} is corrupt.")
+            for path in other_paths:
+                shutil.copyfile(first_path, path)
+    if n_found != len(hashes):
+        raise RuntimeError("Code package refers to files that are missing from the database.")
+
+    for entry in manifest:
+        if "mode" in entry:
+            os.chmod(os.path.join(destination, entry["path"]), entry["mode"])
 
 
 InfluxSeries = namedtuple("InfluxEntry", ["measurement", "tags", "data"])
@@ -1,9 +1,9 @@
 #!/usr/bin/env python3
 
-from bson.objectid import ObjectId
-
 import jobmonitor.delete
-from jobmonitor.connections import mongo
+from jobmonitor.lazy_loader import LazyLoader
+
+c = LazyLoader("c", globals(), "jobmonitor.connections")
 
 
 """
@@ -11,9 +11,9 @@ Kill a job if it is running on kubernetes
 """
 
 
-def bug(job_id):
-    mongo.job.update_one(
-        {'_id': ObjectId(job_id)},
+def bug(jobs):
+    c.mongo.job.update_many(
+        {'_id': {'$in': [job['_id'] for job in jobs]}},
         {'$set': {'annotations.bug': True}}
     )
 
@@ -0,0 +1,152 @@
+"""
+Node-local cache of extracted code packages.
+
+Many jobs of a sweep share the same code package. Each package is downloaded
+and extracted once per node into JOBMONITOR_CODE_CACHE_DIR, and jobs get their
+code directory populated from there with copy-on-write clones or hardlinks
+when the filesystem allows it, and with plain copies otherwise.
+Files in the cache are read-only, so hardlinked code can't corrupt the cache.
+Hardlinked files stay read-only in the job's code directory, clones and copies are
+writable again. The cache directory is private to its user.
+
+Concurrent workers coordinate with file locks. When the cache grows beyond
+JOBMONITOR_CODE_CACHE_SIZE_MB, the least recently used packages are evicted.
+"""
+
+import fcntl
+import os
+import shutil
+import stat
+import tempfile
+from contextlib import contextmanager
+
+from jobmonitor.api import download_code_package
+from jobmonitor.utils import make_private_dir, reflink
+
+CACHE_DIR = os.getenv(
+    "JOBMONITOR_CODE_CACHE_DIR",
+    os.path.join(tempfile.gettempdir(), f"jobmonitor-code-cache-{os.getuid()}"),
+)
+CACHE_SIZE_MB = int(os.getenv("JOBMONITOR_CODE_CACHE_SIZE_MB", 5000))
+
+
+def is_enabled():
+    return bool(CACHE_DIR)
+
+
+def fetch_code_package(package_id, destination, cache_dir=None, max_size_mb=None):
+    """Populate `destination` with the contents of a code package, through the cache"""
+    cache_dir = cache_dir or CACHE_DIR
+    max_size_mb = max_size_mb if max_size_mb is not None else CACHE_SIZE_MB
+    # Code from a directory that another user can write to could be replaced before it runs
+    make_private_dir(cache_dir)
+    entry = os.path.join(cache_dir, str(package_id))
+
+    with _lock(entry + ".lock", fcntl.LOCK_EX) as lock_file:
+        if not os.path.isdir(entry):
+            _add_entry(package_id, entry)
+        # Mark as recently used
+        os.utime(entry)
+        # Other workers may read this entry at the same time, but it can't be evicted
+        fcntl.flock(lock_file, fcntl.LOCK_SH)
+        _populate(entry, destination)
+
+    evict(cache_dir, max_size_mb * 1024 * 1024)
+
+
+def evict(cache_dir, max_size):
+    """Remove least recently used entries that are not in use until the cache fits in `max_size`"""
+    with _lock(os.path.join(cache_dir, ".evict.lock"), fcntl.LOCK_EX):
+        entries = []
+        for name in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, name)
+            if os.path.isdir(path) and os.path.isfile(path + ".size"):
+                with open(path + ".size") as fp:
+                    entries.append((os.stat(path).st_mtime, int(fp.read()), path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= max_size:
+                break
+            try:
+                with _lock(path + ".lock", fcntl.LOCK_EX | fcntl.LOCK_NB):
+                    os.remove(path + ".size")
+                    shutil.rmtree(path)
+                total_size -= size
+            except BlockingIOError:
+                # In use by another worker
+                continue
+
+
+def _add_entry(package_id, entry):
+    partial = entry + ".partial"
+    if os.path.isdir(partial):
+        shutil.rmtree(partial)
+    download_code_package(package_id, partial)
+
+    size = 0
+    # Symlinks to directories are listed in `dirs` and not followed, they take no space
+    for root, dirs, files in os.walk(partial):
+        for filename in files:
+            path = os.path.join(root, filename)
+            if not os.path.islink(path):
+                size += os.path.getsize(path)
+                mode = os.stat(path).st_mode
+                os.chmod(path, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+    with open(entry + ".size", "w") as fp:
+        fp.write(str(size))
+
+    # Entries only appear once they are complete
+    os.rename(partial, entry)
+
+
+def _populate(entry, destination):
+    clone_fn = None
+    for root, dirs, files in os.walk(entry):
+        target_root = os.path.join(destination, os.path.relpath(root, entry))
+        os.makedirs(target_root, exist_ok=True)
+        for name in dirs:
+            # os.walk lists symlinks to directories with the directories, and doesn't follow them
+            source = os.path.join(root, name)
+            if os.path.islink(source):
+                target = os.path.join(target_root, name)
+                if os.path.isdir(target) and not os.path.islink(target):
+                    shutil.rmtree(target)
+                elif os.path.lexists(target):
+                    os.remove(target)
+                os.symlink(os.readlink(source), target)
+        for filename in files:
+            source = os.path.join(root, filename)
+            target = os.path.join(target_root, filename)
+            if os.path.lexists(target):
+                os.remove(target)
+            if os.path.islink(source):
+                os.symlink(os.readlink(source), target)
+                continue
+            if clone_fn is None:
+                # Find out what the filesystems support on the first file
+                for candidate in [reflink, os.link, shutil.copy2]:
+                    try:
+                        candidate(source, target)
+                        clone_fn = candidate
+                        break
+                    except OSError:
+                        if os.path.lexists(target):
+                            os.remove(target)
+                else:
+                    raise RuntimeError(f"Could not copy {source} to {target}")
+            else:
+                clone_fn(source, target)
+            if clone_fn is not os.link:
+                # Hardlinks share their mode with the cache, clones and copies are the job's own
+                os.chmod(target, os.stat(target).st_mode | stat.S_IWUSR)
+
+
+@contextmanager
+def _lock(path, operation):
+    with open(path, "a") as lock_file:
+        fcntl.flock(lock_file, operation)
+        try:
+            yield lock_file
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
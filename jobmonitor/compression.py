@@ -0,0 +1,129 @@
+"""
+Streaming compression codecs for code packages.
+
+- gzip: deflate (zlib), single-threaded (default, no extra dependencies)
+- zstd: multi-threaded Zstandard, requires `pip install zstandard`
+- lz4: very fast, larger output, requires `pip install lz4`
+- none: no compression, for content that is already compressed
+"""
+
+CODECS = ["gzip", "zstd", "lz4", "none"]
+
+READ_SIZE = 1024 * 1024
+
+
+def compressor(codec):
+    """A streaming compressor with `compress(data)` and `flush()`"""
+    if codec == "gzip":
+        import zlib
+
+        return zlib.compressobj()
+    elif codec == "zstd":
+        import zstandard
+
+        return zstandard.ZstdCompressor(threads=-1).compressobj()
+    elif codec == "lz4":
+        return _Lz4Compressor()
+    elif codec == "none":
+        return _Identity()
+    else:
+        raise ValueError(f"Unknown compression codec {codec}. Options: {CODECS}")
+
+
+def decompressor(codec):
+    """A streaming decompressor with `decompress(data)` and `flush()`"""
+    if codec == "gzip":
+        import zlib
+
+        return zlib.decompressobj()
+    elif codec == "zstd":
+        import zstandard
+
+        return _Flushless(zstandard.ZstdDecompressor().decompressobj())
+    elif codec == "lz4":
+        import lz4.frame
+
+        return _Flushless(lz4.frame.LZ4FrameDecompressor())
+    elif codec == "none":
+        return _Identity()
+    else:
+        raise ValueError(f"Unknown compression codec {codec}. Options: {CODECS}")
+
+
+class CompressedWriter:
+    """Write-only file object that compresses everything written to it into `fp`"""
+
+    def __init__(self, fp, codec):
+        self.fp = fp
+        self.compressor = compressor(codec)
+
+    def write(self, data):
+        self.fp.write(self.compressor.compress(data))
+        return len(data)
+
+    def close(self):
+        self.fp.write(self.compressor.flush())
+
+
+class DecompressedReader:
+    """Read-only file object that decompresses what it reads from `fp`"""
+
+    def __init__(self, fp, codec):
+        self.fp = fp
+        self.decompressor = decompressor(codec)
+        self._buffer = bytearray()
+        self._eof = False
+
+    def read(self, size=-1):
+        while (size is None or size < 0 or len(self._buffer) < size) and not self._eof:
+            data = self.fp.read(READ_SIZE)
+            if data:
+                self._buffer += self.decompressor.decompress(data)
+            else:
+                self._buffer += self.decompressor.flush()
+                self._eof = True
+        if size is None or size < 0:
+            size = len(self._buffer)
+        output = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return output
+
+
+class _Lz4Compressor:
+    def __init__(self):
+        import lz4.frame
+
+        self._compressor = lz4.frame.LZ4FrameCompressor()
+        self._header = self._compressor.begin()
+
+    def compress(self, data):
+        output = self._header + self._compressor.compress(data)
+        self._header = b""
+        return output
+
+    def flush(self):
+        return self._header + self._compressor.flush()
+
+
+class _Flushless:
+    """Adds a no-op `flush()` to decompressors that don't buffer output"""
+
+    def __init__(self, decompressor):
+        self._decompressor = decompressor
+
+    def decompress(self, data):
+        return self._decompressor.decompress(data)
+
+    def flush(self):
+        return b""
+
+
+class _Identity:
+    def compress(self, data):
+        return data
+
+    def decompress(self, data):
+        return data
+
+    def flush(self):
+        return b""
@@ -2,120 +2,104 @@
 
 import os
 import shutil
-import subprocess
 import sys
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import kubernetes
 from bson.objectid import ObjectId
 
-from jobmonitor.api import delete_job_by_id, job_by_id, kubernetes_delete_job
-from jobmonitor.connections import KUBERNETES_NAMESPACE, mongo
+from jobmonitor.api import delete_jobs_by_id
+from jobmonitor.lazy_loader import LazyLoader
+
+c = LazyLoader("c", globals(), "jobmonitor.connections")
 
 
 """
-Delete all traces of a previously scheduled job (kubernetes, mongodb, filesystem)
+Delete all traces of previously scheduled jobs (mongodb, filesystem)
 """
 
+# Fields of the selected jobs that the actions and the confirmation list need
+SELECTION_FIELDS = ["experiment", "job", "status", "output_dir"]
+
+# Output directories are removed by this many threads in parallel.
+# On shared storage, removing files is bound by latency rather than bandwidth.
+DELETE_THREADS = 16
+
 
-def delete_job(job_id):
-    print("# Job", job_id)
-    kill_workers(job_id)
+def delete_jobs(jobs, threads=DELETE_THREADS):
+    """Cancel the jobs, remove their output directories, and delete them from MongoDB"""
+    kill_jobs(jobs)
 
     # influx.query("DELETE WHERE job_id='{}'".format(job_id))
     # print("- Deleted all traces of this job id in InfluxDB")
 
-    job = job_by_id(job_id)
-    if job:
-        if "output_dir" in job:
-            output_dir = job["output_dir"]
-            try:
-                shutil.rmtree(os.path.join(os.getenv("JOBMONITOR_RESULTS_DIR"), job["output_dir"]))
-            except FileNotFoundError:
-                pass
-            print("- Cleared output directory {}".format(output_dir))
-
-        delete_job_by_id(job_id)
-        print("- Deleted entry in MongoDB")
-        print("\n")
-    else:
-        print("- No MongoDB entry found")
-
-
-def kill_workers(job_id):
-    # deleted_stuff = []
-
-    # # See if there is a kubernetes job associated to this job
-    # kubernetes.config.load_kube_config()
-    # client = kubernetes.client.BatchV1Api()
-    # job_results = client.list_namespaced_job(
-    #     KUBERNETES_NAMESPACE, label_selector="job_id=" + job_id
-    # )
-    # if job_results.items:
-    #     for job in job_results.items:
-    #         if job.spec.completions == 1:  # Don't kill queue jobs
-    #             name = job.metadata.name
-    #             kubernetes_delete_job(name)
-    #             if name:
-    #                 print("- Killed job {} in Kubernetes".format(name))
-    #                 deleted_stuff.append(name)
-
-    # client = kubernetes.client.CoreV1Api()
-
-    # # Are there pods with the job_id registered?
-    # for pod in client.list_namespaced_pod(
-    #     KUBERNETES_NAMESPACE, label_selector="job_id=" + job_id
-    # ).items:
-    #     body = kubernetes.client.V1DeleteOptions(propagation_policy="Foreground")
-    #     client.delete_namespaced_pod(pod.metadata.name, namespace=KUBERNETES_NAMESPACE, body=body)
-    #     deleted_stuff.append(pod.metadata.name)
-    #     print("- Killed pod {} in Kubernetes".format(pod.metadata.name))
-
-    # # – Try to find a pod by the job's registered hostname
-    # job = job_by_id(job_id)
-    # if "host" in job:
-    #     pod_results = client.list_namespaced_pod(
-    #         KUBERNETES_NAMESPACE,
-    #         limit=1,
-    #         label_selector="user=" + job["user"],
-    #         field_selector="metadata.name=" + job["host"],
-    #     )
-    #     if pod_results.items:
-    #         pod = pod_results.items[0]
-    #         name = pod.metadata.name
-    #         body = kubernetes.client.V1DeleteOptions(propagation_policy="Foreground")
-    #         client.delete_namespaced_pod(name, namespace=KUBERNETES_NAMESPACE, body=body)
-    #         if name:
-    #             print("- Killed pod {} in Kubernetes".format(name))
-    #             deleted_stuff.append(name)
-
-    # # Is the pod running on the iccluster?
-    # if "workers" in job and job["workers"]:
-    #     if job["status"] in ["SCHEDULED", "RUNNING"]:
-    #         for worker_no, info in job["workers"].items():
-    #             if info["host"].startswith("iccluster"):
-    #                 try:
-    #                     subprocess.check_call(["ssh", info["host"], "kill", str(info["pid"])])
-    #                     print("- Killed iccluster worker", info)
-    #                 except subprocess.CalledProcessError:
-    #                     pass
-
-    # Set status to CANCELED in MongoDB if the job is still RUNNING
-    mongo.job.update(
-        {"_id": ObjectId(job_id), "status": "RUNNING"}, {"$set": {"status": "CANCELED"}}
+    failed_job_ids = set()
+    jobs_with_output = [job for job in jobs if "output_dir" in job]
+    if jobs_with_output:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            futures = {pool.submit(remove_output_dir, job): job for job in jobs_with_output}
+            for n_done, future in enumerate(as_completed(futures), 1):
+                try:
+                    future.result()
+                except OSError as e:
+                    job = futures[future]
+                    failed_job_ids.add(job["_id"])
+                    print(f"\n- Could not clear output directory {job['output_dir']}: {e}")
+                print(
+                    f"\r- Cleared output directories: {n_done}/{len(jobs_with_output)}",
+                    end="",
+                    flush=True,
+                )
+        print()
+
+    # Jobs whose output could not be removed stay, so the deletion can be retried
+    job_ids = [job["_id"] for job in jobs if job["_id"] not in failed_job_ids]
+    n_deleted = delete_jobs_by_id(job_ids).deleted_count
+    print(f"- Deleted {n_deleted} entries in MongoDB")
+    if failed_job_ids:
+        print(f"- Kept {len(failed_job_ids)} entries whose output directory is still there")
+
+
+def remove_output_dir(job):
+    try:
+        shutil.rmtree(os.path.join(os.getenv("JOBMONITOR_RESULTS_DIR"), job["output_dir"]))
+    except FileNotFoundError:
+        pass
+
+
+def kill_jobs(jobs):
+    """Set jobs that are still RUNNING to CANCELED, their workers stop by themselves"""
+    result = c.mongo.job.update_many(
+        {"_id": {"$in": [job["_id"] for job in jobs]}, "status": "RUNNING"},
+        {"$set": {"status": "CANCELED"}},
     )
+    print(f"- Canceled {result.modified_count} running jobs")
+
 
+def select_jobs(job_ids, query):
+    """The jobs with the given IDs and those matching `query`, in one projected query"""
+    conditions = []
+    if job_ids:
+        conditions.append({"_id": {"$in": [ObjectId(job_id) for job_id in job_ids]}})
+    if query != {}:
+        conditions.append(query)
+    if not conditions:
+        return []
+    return list(c.mongo.job.find({"$or": conditions}, SELECTION_FIELDS))
 
-def main(delete_fn=delete_job, action_name="delete"):
+
+def main(action_fn=delete_jobs, action_name="delete"):
+    """`action_fn` is called with the selected jobs, which have the fields in SELECTION_FIELDS"""
     parser = ArgumentParser()
     parser.add_argument("job_ids", nargs="*", help="IDs of the jobs to be removed.")
     parser.add_argument("--job")
     parser.add_argument("--experiment")
     parser.add_argument("--status")
+    parser.add_argument(
+        "--dry-run", default=False, action="store_true", help="Only list the selected jobs."
+    )
     args = parser.parse_args()
 
-    to_be_deleted = args.job_ids
-
     query = {}
     if args.experiment is not None:
         query["experiment"] = args.experiment
@@ -124,18 +108,21 @@ def main(delete_fn=delete_job, action_name="delete"):
     if args.status is not None:
         query["status"] = args.status
 
-    if query != {}:
-        for job in mongo.job.find(query, {}):
-            to_be_deleted.append(str(job["_id"]))
+    jobs = select_jobs(args.job_ids, query)
 
-    if len(to_be_deleted) == 0:  # if query matches no jobs or no job_ids provided
+    if len(jobs) == 0:  # if query matches no jobs or no job_ids provided
         print("No jobs found that match the provided criteria.")
         sys.exit(1)
 
-    print("Should I {}:".format(action_name))
-    for id in to_be_deleted:
-        job = job_by_id(id)
-        print("- {experiment} / {job} -- {status}".format(**job))
+    print("{} {} jobs:".format("Would" if args.dry_run else "Should I", action_name))
+    for job in jobs:
+        line = "- {experiment} / {job} -- {status}".format(**job)
+        if args.dry_run and "output_dir" in job:
+            line += f" -- {job['output_dir']}"
+        print(line)
+
+    if args.dry_run:
+        return
 
     answer = None
     while answer not in ["Y", "y", "N", "n", ""]:
@@ -144,8 +131,7 @@ def main(delete_fn=delete_job, action_name="delete"):
     if answer.lower() == "n":
         print("Canceled ...")
     else:
-        for job_id in to_be_deleted:
-            delete_fn(job_id)
+        action_fn(jobs)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+
+"""
+Node-local heartbeat agent.
+
+Workers hand their heartbeats to an agent on the same node over a Unix datagram socket,
+and the agent writes everything it received to MongoDB in one `bulk_write` every
+FLUSH_INTERVAL seconds, together with the renewals of the workers' queue leases.
+The first jobrun process on a node that finds no agent becomes the agent, and another
+one takes over when it exits. The agent can also be run as a standalone daemon with
+`jobheartbeat`. Workers write directly to MongoDB whenever the agent can't be reached.
+
+Set JOBMONITOR_HEARTBEAT_SOCKET to an empty string to disable the agent, or to a path in a
+directory that only this user can write to.
+"""
+
+import datetime
+import fcntl
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+
+from jobmonitor import job_queue
+from jobmonitor.lazy_loader import LazyLoader
+from jobmonitor.utils import make_private_dir
+
+c = LazyLoader("c", globals(), "jobmonitor.connections")
+
+# The socket and its lock file are in a directory that only this user can write to.
+# Otherwise, another user could hold the lock and pose as the agent.
+SOCKET_PATH = os.getenv(
+    "JOBMONITOR_HEARTBEAT_SOCKET",
+    os.path.join(tempfile.gettempdir(), f"jobmonitor-heartbeat-{os.getuid()}", "agent.sock"),
+)
+
+# Received heartbeats reach the database at most this many seconds later
+FLUSH_INTERVAL = 5
+
+# The agent touches its lock file every FLUSH_INTERVAL seconds. Workers don't hand their
+# heartbeats to an agent that didn't do so for this many seconds, but write them themselves.
+AGENT_TIMEOUT = 3 * FLUSH_INTERVAL
+
+_agent = None
+_socket = None
+_has_private_directory = None
+
+
+def is_enabled():
+    return bool(SOCKET_PATH)
+
+
+def send(job_id, rank, lease_rank=None):
+    """
+    Hand a heartbeat to the node's agent, and become the agent if there is none.
+    Returns False if no agent could take it, then the caller should write it itself.
+    """
+    global _agent
+    global _socket
+    if not is_enabled() or not _check_directory():
+        return False
+
+    if _agent is None:
+        agent = HeartbeatAgent(SOCKET_PATH)
+        if agent.try_acquire():
+            agent.start()
+            _agent = agent
+
+    if _agent is not None:
+        if not _agent.is_alive():
+            return False
+    elif not _agent_is_alive(SOCKET_PATH):
+        # The process that holds the lock doesn't serve the socket (anymore)
+        return False
+
+    if _socket is None:
+        _socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        _socket.setblocking(False)
+    message = json.dumps(
+        {
+            "job_id": str(job_id),
+            "rank": rank,
+            "lease_rank": rank if lease_rank is None else lease_rank,
+            "time": time.time(),
+        }
+    )
+    try:
+        _socket.sendto(message.encode("utf-8"), SOCKET_PATH)
+        return True
+    except OSError:
+        # No agent listening, or it can't keep up
+        return False
+
+
+class HeartbeatAgent(threading.Thread):
+    """Receives heartbeats on a Unix socket and writes them to MongoDB in bulk"""
+
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL):
+        threading.Thread.__init__(self, daemon=True)
+        self.path = path
+        self.flush_interval = flush_interval
+        self._lock_file = None
+        self._socket = None
+        self._stopped = threading.Event()
+
+    def try_acquire(self):
+        """
+        Become the node's agent unless another process is.
+        Holds a lock until this process exits, see `_forget_agent_after_fork`.
+        """
+        lock_file = open(self.path + ".lock", "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+
+        # A socket file without a lock holder is left over from an agent that died
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.bind(self.path)
+        self._touch()
+        return True
+
+    def close_inherited(self):
+        """
+        Close a forked child's copies of the lock file and the socket, without unlocking.
+        Otherwise the child keeps the lock after the agent's process exits, with nobody reading.
+        """
+        self._socket.close()
+        self._lock_file.close()
+
+    def _touch(self):
+        """Show workers that this agent is alive"""
+        try:
+            os.utime(self.path + ".lock")
+        except OSError:
+            pass
+
+    def close(self):
+        """Stop after writing the heartbeats received so far"""
+        self._stopped.set()
+        # Wake up the receiving thread
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as wake:
+            try:
+                wake.sendto(b"", self.path)
+            except OSError:
+                pass
+        self.join()
+
+    def run(self):
+        # (job_id, rank, lease_rank) -> time of the latest heartbeat
+        pending = {}
+        next_flush = time.time() + self.flush_interval
+        while not self._stopped.is_set():
+            self._socket.settimeout(max(next_flush - time.time(), 0.01))
+            try:
+                self._receive(self._socket.recv(4096), pending)
+            except socket.timeout:
+                pass
+
+            if time.time() >= next_flush:
+                if pending:
+                    self._write(pending)
+                    pending = {}
+                self._touch()
+                next_flush = time.time() + self.flush_interval
+
+        # Heartbeats that arrived before `close()`
+        self._socket.setblocking(False)
+        while True:
+            try:
+                self._receive(self._socket.recv(4096), pending)
+            except BlockingIOError:
+                break
+        if pending:
+            self._write(pending)
+
+    def _receive(self, message, pending):
+        try:
+            beat = json.loads(message)
+            key = (beat["job_id"], beat["rank"], beat.get("lease_rank", beat["rank"]))
+            pending[key] = max(pending.get(key, 0), beat["time"])
+        except (ValueError, KeyError, TypeError):
+            # Not a heartbeat
+            pass
+
+    def _write(self, heartbeats):
+        updates = {}
+        lease_renewals = []
+        for (job_id, rank, lease_rank), timestamp in heartbeats.items():
+            heartbeat_time = datetime.datetime.utcfromtimestamp(timestamp)
+            lease_renewals.append(
+                job_queue.renew_lease_operation(job_id, lease_rank, heartbeat_time)
+            )
+            update = updates.setdefault(job_id, {})
+            update[f"workers.{rank}.last_heartbeat_time"] = heartbeat_time
+            update["last_heartbeat_time"] = max(
+                update.get("last_heartbeat_time", heartbeat_time), heartbeat_time
+            )
+        operations = [
+            UpdateOne({"_id": ObjectId(job_id)}, {"$max": update})
+            for job_id, update in updates.items()
+        ]
+        try:
+            c.mongo.job.bulk_write(operations, ordered=False)
+            c.mongo.job_queue.bulk_write(lease_renewals, ordered=False)
+        except Exception as e:
+            print(f"Heartbeat agent failed to write heartbeats: {e!r}", file=sys.__stderr__)
+
+
+def close():
+    """Stop this process's agent, if it is one, once it wrote the heartbeats it received"""
+    if _agent is not None and _agent.is_alive():
+        _agent.close()
+
+
+def _check_directory():
+    """Whether the socket's directory is private, checked once per process"""
+    global _has_private_directory
+    if _has_private_directory is None:
+        try:
+            make_private_dir(os.path.dirname(SOCKET_PATH))
+            _has_private_directory = True
+        except PermissionError as e:
+            print(f"Not using a heartbeat agent: {e}", file=sys.__stderr__)
+            _has_private_directory = False
+    return _has_private_directory
+
+
+def _agent_is_alive(path):
+    try:
+        return os.stat(path + ".lock").st_mtime > time.time() - AGENT_TIMEOUT
+    except OSError:
+        return False
+
+
+def _forget_agent_after_fork():
+    """Threads don't survive a fork. The parent stays the agent if it was."""
+    global _agent
+    global _socket
+    if _agent is not None:
+        _agent.close_inherited()
+    if _socket is not None:
+        _socket.close()
+    _agent = None
+    _socket = None
+
+
+os.register_at_fork(after_in_child=_forget_agent_after_fork)
+
+
+def main():
+    if not is_enabled():
+        print("The heartbeat agent is disabled (JOBMONITOR_HEARTBEAT_SOCKET is empty).")
+        sys.exit(1)
+    try:
+        make_private_dir(os.path.dirname(SOCKET_PATH))
+    except PermissionError as e:
+        print(e)
+        sys.exit(1)
+    agent = HeartbeatAgent(SOCKET_PATH)
+    if not agent.try_acquire():
+        print(f"Another heartbeat agent is serving {SOCKET_PATH}.")
+        sys.exit(1)
+    print(f"Collecting heartbeats on {SOCKET_PATH}")
+    agent.run()
+
+
+if __name__ == "__main__":
+    main()
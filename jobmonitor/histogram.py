@@ -0,0 +1,84 @@
+"""
+Log-bucketed latency histograms.
+
+Durations are counted in buckets whose width grows with the duration (BUCKETS_PER_OCTAVE per
+factor 2), so any percentile is known within ~0.5% regardless of the scale, with a few
+hundred buckets at most. Histograms merge by adding bucket counts, which also works inside
+MongoDB with `$inc`, so workers and jobs can be combined freely.
+"""
+
+import math
+
+BUCKETS_PER_OCTAVE = 64
+
+# Durations below this many seconds are counted as this value
+MIN_VALUE = 1e-9
+
+
+def bucket_index(value):
+    return math.floor(math.log2(max(value, MIN_VALUE)) * BUCKETS_PER_OCTAVE)
+
+
+def bucket_value(index):
+    """Geometric center of a bucket"""
+    return 2 ** ((index + 0.5) / BUCKETS_PER_OCTAVE)
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def record(self, value):
+        index = bucket_index(value)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def mean(self):
+        return self.sum / self.count if self.count else math.nan
+
+    def quantile(self, q):
+        if self.count == 0:
+            return math.nan
+        rank = q * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(max(bucket_value(index), self.min), self.max)
+        return self.max
+
+    def to_document(self):
+        """MongoDB representation. Bucket indices become string keys."""
+        return {
+            "buckets": {str(index): count for index, count in self.buckets.items()},
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+        }
+
+    @classmethod
+    def from_document(cls, document):
+        histogram = cls()
+        histogram.buckets = {int(index): count for index, count in document["buckets"].items()}
+        histogram.count = document["count"]
+        histogram.sum = document["sum"]
+        histogram.min = document["min"]
+        histogram.max = document["max"]
+        return histogram
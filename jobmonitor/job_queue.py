@@ -0,0 +1,191 @@
+"""
+The job queue: one small document per worker slot of a job, in the collection `job_queue`.
+
+    {
+        "_id": "5be59ae368999dde8ed9545d.0",  # job id and rank
+        "job_id": ObjectId("5be59ae368999dde8ed9545d"),
+        "rank": 0,
+        "n_workers": 2,
+        "priority": 1,
+        "creation_time": ...,
+        "started": False,  # set when the job starts RUNNING
+        "lease_owner": "host:pid",
+        "lease_expiry": ...,
+        "attempts": 1,
+    }
+
+Workers claim a slot by taking a lease on it, and renew the lease with every heartbeat.
+When a worker dies before its job started, its lease expires and the slot is offered
+to the next worker that asks, at most MAX_ATTEMPTS times in total. After that, the job
+is marked FAILED. Slots are removed when their job ends or is deleted.
+Claims only touch these documents, never the job documents with their logs and metrics.
+"""
+
+import datetime
+import os
+import socket
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, UpdateOne
+
+from jobmonitor.lazy_loader import LazyLoader
+
+c = LazyLoader("c", globals(), "jobmonitor.connections")
+
+# A claimed slot is offered to other workers when its lease was not renewed for this
+# many seconds. Workers renew their leases with every heartbeat (every 10 seconds).
+LEASE_DURATION = 60
+
+# A slot is leased at most this many times. Workers that keep dying before the job starts,
+# e.g. because its code can't be cloned, would otherwise take it forever.
+MAX_ATTEMPTS = 3
+
+# Free slots have a lease that expired long ago
+_NO_LEASE = datetime.datetime(1970, 1, 1)
+
+
+def slot_id(job_id, rank):
+    return f"{job_id}.{rank}"
+
+
+def enqueue_job(job_id, n_workers, priority, creation_time):
+    """Offer the worker slots of a job. Slots that are already in the queue are kept."""
+    operations = [
+        UpdateOne(
+            {"_id": slot_id(job_id, rank)},
+            {
+                "$setOnInsert": {
+                    "job_id": ObjectId(job_id),
+                    "rank": rank,
+                    "n_workers": n_workers,
+                    "priority": priority,
+                    "creation_time": creation_time,
+                    "started": False,
+                    "lease_owner": None,
+                    "lease_expiry": _NO_LEASE,
+                    "attempts": 0,
+                }
+            },
+            upsert=True,
+        )
+        for rank in range(n_workers)
+    ]
+    c.mongo.job_queue.bulk_write(operations, ordered=False)
+
+
+def claim_slot(job_ids=None, min_worker_count=None, owner=None):
+    """
+    Take a lease on the highest-priority, oldest free slot, or on one whose lease expired.
+    Returns the slot document, or None if there is nothing to do.
+    """
+    if owner is None:
+        owner = f"{socket.gethostname()}:{os.getpid()}"
+    now = datetime.datetime.utcnow()
+    query = {"started": False, "lease_expiry": {"$lt": now}, "attempts": {"$lt": MAX_ATTEMPTS}}
+    if job_ids is not None:
+        query["job_id"] = {"$in": [ObjectId(job_id) for job_id in job_ids]}
+    if min_worker_count is not None:
+        query["n_workers"] = {"$gte": min_worker_count}
+    return c.mongo.job_queue.find_one_and_update(
+        query,
+        {
+            "$set": {
+                "lease_owner": owner,
+                "lease_expiry": now + datetime.timedelta(seconds=LEASE_DURATION),
+            },
+            "$inc": {"attempts": 1},
+        },
+        sort=[("priority", DESCENDING), ("creation_time", ASCENDING), ("rank", ASCENDING)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def renew_lease_operation(job_id, rank, heartbeat_time):
+    """Update that extends a slot's lease from the time of a heartbeat, for bulk writes"""
+    return UpdateOne({"_id": slot_id(job_id, rank)}, _renewal(heartbeat_time))
+
+
+def renew_lease(job_id, rank, w=None):
+    """w: mongodb writeConcern, use w=0 to continue without acknowledgement"""
+    c.mongo.job_queue.update(
+        {"_id": slot_id(job_id, rank)}, _renewal(datetime.datetime.utcnow()), w=w
+    )
+
+
+def _renewal(heartbeat_time):
+    # A delayed heartbeat never shortens a lease
+    return {"$max": {"lease_expiry": heartbeat_time + datetime.timedelta(seconds=LEASE_DURATION)}}
+
+
+def mark_started(job_id):
+    """The job is running, its slots are not offered again when their leases expire"""
+    c.mongo.job_queue.update_many({"job_id": ObjectId(job_id)}, {"$set": {"started": True}})
+
+
+def dequeue_job(job_id):
+    c.mongo.job_queue.delete_many({"job_id": ObjectId(job_id)})
+
+
+def release_orphaned_slots():
+    """Remove the slots of jobs that ended or were deleted without removing them"""
+    job_ids = c.mongo.job_queue.distinct("job_id")
+    active_job_ids = {
+        job["_id"]
+        for job in c.mongo.job.find(
+            {"_id": {"$in": job_ids}, "status": {"$in": ["CREATED", "SCHEDULED", "RUNNING"]}}, {}
+        )
+    }
+    orphaned_job_ids = [job_id for job_id in job_ids if job_id not in active_job_ids]
+    if not orphaned_job_ids:
+        return 0
+    return c.mongo.job_queue.delete_many({"job_id": {"$in": orphaned_job_ids}}).deleted_count
+
+
+def fail_exhausted_jobs():
+    """Mark jobs FAILED whose slots were leased MAX_ATTEMPTS times without the job starting"""
+    job_ids = c.mongo.job_queue.distinct(
+        "job_id",
+        {
+            "started": False,
+            "lease_expiry": {"$lt": datetime.datetime.utcnow()},
+            "attempts": {"$gte": MAX_ATTEMPTS},
+        },
+    )
+    if not job_ids:
+        return 0
+    c.mongo.job.update_many(
+        {"_id": {"$in": job_ids}, "status": {"$in": ["CREATED", "SCHEDULED"]}},
+        {
+            "$set": {
+                "status": "FAILED",
+                "end_time": datetime.datetime.utcnow(),
+                "exception": f"Workers stopped before the job started, {MAX_ATTEMPTS} times",
+            }
+        },
+    )
+    c.mongo.job_queue.delete_many({"job_id": {"$in": job_ids}})
+    return len(job_ids)
+
+
+def enqueue_waiting_jobs(job_ids=None):
+    """
+    Add the slots of jobs that wait for workers but are not in the queue, e.g. older jobs
+    or jobs that were not created with `register_job`. Optionally only for `job_ids`.
+    """
+    query = {"status": {"$in": ["CREATED", "SCHEDULED"]}, "registered_workers": {"$in": [0, None]}}
+    if job_ids is not None:
+        query["_id"] = {"$in": [ObjectId(job_id) for job_id in job_ids]}
+        queued_job_ids = set(c.mongo.job_queue.distinct("job_id", {"job_id": query["_id"]}))
+    else:
+        queued_job_ids = set(c.mongo.job_queue.distinct("job_id"))
+    n_enqueued = 0
+    for job in c.mongo.job.find(query, {"n_workers": 1, "priority": 1, "creation_time": 1}):
+        if job["_id"] not in queued_job_ids:
+            enqueue_job(
+                job["_id"],
+                job.get("n_workers", 1),
+                job.get("priority", 1),
+                job.get("creation_time", datetime.datetime.utcnow()),
+            )
+            n_enqueued += 1
+    return n_enqueued
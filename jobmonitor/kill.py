@@ -9,7 +9,7 @@ Kill a job if it is running on kubernetes
 
 
 def main():
-    jobmonitor.delete.main(jobmonitor.delete.kill_workers, action_name="kill")
+    jobmonitor.delete.main(jobmonitor.delete.kill_jobs, action_name="kill")
 
 
 if __name__ == "__main__":
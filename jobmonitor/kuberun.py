@@ -1,13 +1,15 @@
 #!/usr/bin/env python3
 
 import os
-import numpy as np
+import random
 from argparse import ArgumentParser
 
-from kubernetes import client, config, watch
-
 from jobmonitor.api import kubernetes_create_base_pod_spec
 from jobmonitor.connections import KUBERNETES_NAMESPACE
+from jobmonitor.lazy_loader import LazyLoader
+
+client = LazyLoader("client", globals(), "kubernetes.client")
+config = LazyLoader("config", globals(), "kubernetes.config")
 
 
 """
@@ -55,8 +57,7 @@ def main():
     if args.pod_name:
         pod_name = args.pod_name
     else:
-        random = np.random.randint(low=1_000_000_000, high=9_999_999_999)
-        pod_name = f"{args.user}-{random}"
+        pod_name = f"{args.user}-{random.randint(1_000_000_000, 9_999_999_999)}"
     pod = client.V1Pod(
         metadata=client.V1ObjectMeta(
             name=pod_name, labels=dict(app="jobmonitor", user=args.user, **labels)
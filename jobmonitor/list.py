@@ -1,36 +1,132 @@
 #!/usr/bin/env python3
 
-import os
+import datetime
+import json
+import re
 import sys
 from argparse import ArgumentParser
 
-import yaml
+from pymongo import ASCENDING, DESCENDING
 
-from jobmonitor.connections import mongo
+from jobmonitor.lazy_loader import LazyLoader
+
+c = LazyLoader("c", globals(), "jobmonitor.connections")
 
 """
-Lists either all jobs or jobs with a given status in YAML format.
+Lists jobs, newest first, as a table, as JSON lines, or as full documents in YAML format.
 """
 
+# Fields fetched for the table and JSON output. Everything else stays on the server.
+SUMMARY_FIELDS = [
+    'user',
+    'project',
+    'experiment',
+    'job',
+    'status',
+    'priority',
+    'n_workers',
+    'registered_workers',
+    'host',
+    'creation_time',
+    'start_time',
+    'end_time',
+    'last_heartbeat_time',
+    'annotations',
+]
+
+
 def main():
     parser = ArgumentParser()
     parser.add_argument('--status', help='Only show jobs with given status.', type=str)
+    parser.add_argument('--user', type=str)
+    parser.add_argument('--project', type=str)
+    parser.add_argument('--experiment', type=str)
+    parser.add_argument('--job', help='Regular expression for the job name.', type=str)
+    parser.add_argument(
+        '--since', help='Created after, e.g. 2019-05-01, 2019-05-01T12:00 or 3d, 12h, 30m ago.'
+    )
+    parser.add_argument('--until', help='Created before, same format as --since.')
+    parser.add_argument('-n', '--limit', type=int, default=0, help='Show at most n jobs.')
+    parser.add_argument(
+        '--oldest-first', default=False, action='store_true', help='Sort by creation time.'
+    )
+    parser.add_argument(
+        '-f',
+        '--format',
+        choices=['table', 'json', 'yaml'],
+        default='table',
+        help='json: one job per line. yaml: complete job documents, which can be large.',
+    )
     parser.add_argument('-c', '--config', help='With config', action='store_true', default=False)
     args = parser.parse_args()
 
-    if args.status:
-        jobs = mongo.job.find({'status': args.status})
+    query = {}
+    for field in ['status', 'user', 'project', 'experiment']:
+        if getattr(args, field) is not None:
+            query[field] = getattr(args, field)
+    if args.job is not None:
+        query['job'] = {'$regex': args.job}
+    if args.since is not None or args.until is not None:
+        query['creation_time'] = {}
+        if args.since is not None:
+            query['creation_time']['$gte'] = parse_time(args.since)
+        if args.until is not None:
+            query['creation_time']['$lt'] = parse_time(args.until)
+
+    if args.format == 'yaml':
+        projection = None
     else:
-        jobs = mongo.job.find()
+        projection = SUMMARY_FIELDS + (['config'] if args.config else [])
 
-    if jobs is None:
-        print("No jobs found.")
-        sys.exit(1)
+    jobs = (
+        c.mongo_reader.job.find(query, projection)
+        .sort('creation_time', ASCENDING if args.oldest_first else DESCENDING)
+        .limit(args.limit)
+        .batch_size(500)
+    )
 
+    n_jobs = 0
     for job in jobs:
+        n_jobs += 1
         job['id'] = str(job.pop('_id'))
-        print(yaml.safe_dump(job))
+        if args.format == 'yaml':
+            import yaml
+
+            print(yaml.safe_dump(job))
+        elif args.format == 'json':
+            print(json.dumps(job, default=str))
+        else:
+            if n_jobs == 1:
+                print(f"{'ID':<24}  {'STATUS':<10}  {'CREATED':<16}  {'USER':<10}  NAME")
+            print_row(job, args.config)
+        # Show results as they arrive, also when piped
+        sys.stdout.flush()
+
+    if n_jobs == 0:
+        print("No jobs found.", file=sys.stderr)
+
+
+def print_row(job, with_config=False):
+    created = job.get('creation_time')
+    created = created.strftime('%Y-%m-%d %H:%M') if created is not None else ''
+    name = '/'.join(str(job.get(field, '?')) for field in ['project', 'experiment', 'job'])
+    status = job.get('status', '')
+    user = job.get('user', '')
+    row = f"{job['id']:<24}  {status:<10}  {created:<16}  {user:<10}  {name}"
+    if with_config:
+        row += '  ' + json.dumps(job.get('config', {}), default=str)
+    print(row)
+
+
+def parse_time(text):
+    """An ISO date/time, or a duration like 3d, 12h, 30m ago"""
+    match = re.fullmatch(r'(\d+)([smhdw])', text)
+    if match:
+        unit = {'s': 'seconds', 'm': 'minutes', 'h': 'hours', 'd': 'days', 'w': 'weeks'}
+        delta = datetime.timedelta(**{unit[match.group(2)]: int(match.group(1))})
+        return datetime.datetime.utcnow() - delta
+    return datetime.datetime.fromisoformat(text)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
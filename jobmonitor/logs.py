@@ -4,10 +4,7 @@ import os
 import sys
 from argparse import ArgumentParser
 
-import yaml
-from bson.objectid import ObjectId
-
-from jobmonitor.connections import mongo
+from jobmonitor.api import follow_job_logs, job_logs
 
 
 """
@@ -20,33 +17,43 @@ def main():
     parser.add_argument("job_id", help="ID of the job")
     parser.add_argument("-w", "--worker", help="Only show this worker", type=int)
     parser.add_argument("-t", "--tail", type=int)
+    parser.add_argument(
+        "-f", "--follow", help="Keep printing new lines as they arrive", action="store_true"
+    )
     args = parser.parse_args()
 
-    job = mongo.job.find_one({"_id": ObjectId(args.job_id)}, {"logs": 1})
+    if args.follow and args.tail is None:
+        args.tail = 10
+
+    # Filtering by worker and tail happens in the database
+    lines = job_logs(args.job_id, worker=args.worker, tail=args.tail)
 
-    if job is None:
+    if lines is None:
         print(fg("Job not found.", 1))
         sys.exit(1)
 
-    lines = job.get("logs", [])
-
-    lines = filter(lambda l: l["message"].strip() != "", lines)
-
-    if args.worker is not None:
-        lines = filter(lambda l: l["worker"] == args.worker, lines)
-
-    if args.tail is not None:
-        lines = list(lines)
-        lines = lines[-args.tail :]
-
     for line in lines:
-        if args.worker is None:
-            print(fg("%02d" % line["worker"], 0), end=" ")
-        print(fg(line["time"].strftime("%Y-%m-%d %H:%M:%S"), 0), end=" ")
-        if line["type"] == "error":
-            print(fg(line["message"].strip(), 1))
-        else:
-            print(line["message"].strip())
+        print_line(line, show_worker=args.worker is None)
+
+    if args.follow:
+        since = lines[-1]["time"] if lines else None
+        try:
+            for line in follow_job_logs(args.job_id, worker=args.worker, since=since):
+                print_line(line, show_worker=args.worker is None, flush=True)
+        except KeyboardInterrupt:
+            pass
+
+
+def print_line(line, show_worker, flush=False):
+    if line["message"].strip() == "":
+        return
+    if show_worker:
+        print(fg("%02d" % line["worker"], 0), end=" ")
+    print(fg(line["time"].strftime("%Y-%m-%d %H:%M:%S"), 0), end=" ")
+    if line["type"] == "error":
+        print(fg(line["message"].strip(), 1), flush=flush)
+    else:
+        print(line["message"].strip(), flush=flush)
 
 
 fg = lambda text, color: "\33[38;5;" + str(color) + "m" + text + "\33[0m"
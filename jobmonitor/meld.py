@@ -4,11 +4,10 @@ import os
 import sys
 from argparse import ArgumentParser
 
-import yaml
 import tempfile
 import subprocess
 
-from jobmonitor.api import download_code_package, job_by_id
+from jobmonitor.api import code_package_manifest, diff_manifests, download_code_package, job_by_id
 
 """
 Compare the code of two jobs
@@ -19,18 +18,42 @@ def main():
     parser = ArgumentParser()
     parser.add_argument("job1", type=str)
     parser.add_argument("job2", type=str)
+    parser.add_argument(
+        "--summary", "-s", default=False, action="store_true", help="only list changed files"
+    )
     args = parser.parse_args()
 
     job1 = job_by_id(args.job1)
     job2 = job_by_id(args.job2)
 
+    package_ids = [job["environment"]["clone"]["code_package"] for job in [job1, job2]]
+    manifests = [code_package_manifest(package_id) for package_id in package_ids]
+
+    if None in manifests:
+        # Packages uploaded without a manifest can only be compared in full
+        changes = None
+        if args.summary:
+            print("These code packages have no file list, compare them without --summary.")
+            sys.exit(1)
+    else:
+        changes = diff_manifests(*manifests)
+        if args.summary:
+            for change, path in changes:
+                print(f"{change:<9} {path}")
+            return
+        if not changes:
+            print("The code of these jobs is identical.")
+            return
+
     with tempfile.TemporaryDirectory() as tempdir:
         directories = []
-        for i, job in enumerate([job1, job2]):
+        for i, package_id in enumerate(package_ids):
             code_dir = os.path.join(tempdir, f"job{i}")
+            os.makedirs(code_dir)
             directories.append(code_dir)
-            clone_info = job["environment"]["clone"]
-            download_code_package(clone_info["code_package"], code_dir)
+            # Only the files that differ
+            paths = None if changes is None else {path for _, path in changes}
+            download_code_package(package_id, code_dir, paths=paths)
         subprocess.call(["meld"] + directories)
 
 
@@ -0,0 +1,144 @@
+"""
+Stack-sampling profiler that runs as a thread inside a worker.
+
+It periodically looks at the stack of one thread, and counts how often each stack
+was seen, in the "collapsed" format of flamegraph.pl and speedscope:
+`outer (file.py:12);inner (file.py:40) 37`.
+The time it spends sampling is kept below `max_overhead` of the wall time by sampling
+less often when stacks are expensive to collect, and reported as `overhead`.
+"""
+
+import os
+import sys
+import threading
+from time import perf_counter
+
+
+class SamplingProfiler(threading.Thread):
+    def __init__(
+        self, thread_id, interval=0.01, max_overhead=0.01, on_flush=None, flush_interval=60
+    ):
+        """
+        :param thread_id: `threading.get_ident()` of the thread to sample
+        :param on_flush: called with `snapshot()` every `flush_interval` seconds and when closed
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.max_overhead = max_overhead
+        self.on_flush = on_flush
+        self.flush_interval = flush_interval
+        self.stacks = {}
+        self.samples = 0
+        self.sampling_time = 0.0
+        self.start_time = perf_counter()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def run(self):
+        last_flush = perf_counter()
+        while not self._stopped.is_set():
+            start = perf_counter()
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                # The thread has exited
+                break
+            stack = collapse_stack(frame)
+            del frame
+            with self._lock:
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+                self.samples += 1
+            cost = perf_counter() - start
+            self.sampling_time += cost
+
+            if self.on_flush is not None and start - last_flush > self.flush_interval:
+                self._flush()
+                last_flush = perf_counter()
+
+            # Wait long enough that sampling stays under max_overhead of the time
+            self._stopped.wait(max(self.interval, cost / self.max_overhead))
+
+    def close(self):
+        """Stop sampling and flush the results"""
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
+        if self.on_flush is not None:
+            self._flush()
+
+    def snapshot(self):
+        with self._lock:
+            stacks = dict(self.stacks)
+            samples = self.samples
+        duration = perf_counter() - self.start_time
+        return {
+            "stacks": stacks,
+            "samples": samples,
+            "duration": duration,
+            "interval": self.interval,
+            "overhead": self.sampling_time / duration if duration > 0 else 0.0,
+        }
+
+    def _flush(self):
+        start = perf_counter()
+        try:
+            self.on_flush(self.snapshot())
+        except Exception as e:
+            print(f"Profiler failed to write its results: {e!r}", file=sys.__stderr__)
+        self.sampling_time += perf_counter() - start
+
+
+def collapse_stack(frame):
+    """'outer;...;inner' for a frame and its callers"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        filename = os.path.basename(code.co_filename)
+        names.append(f"{code.co_name} ({filename}:{code.co_firstlineno})".replace(";", ":"))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def intern_stacks(stacks, max_stacks=None, max_bytes=None):
+    """
+    Compact form of {stack: count} for storage, most frequent stacks first:
+    a table of distinct frames, and [{"frames": [index in the table], "count": count}].
+    Stops after `max_stacks` stacks, or when the result would take about `max_bytes`.
+    Returns (frames, stacks, number of samples in the stacks that were left out).
+    """
+    frame_index = {}
+    entries = []
+    size = 0
+    omitted_samples = 0
+    for stack, count in sorted(stacks.items(), key=lambda item: -item[1]):
+        frames = stack.split(";")
+        # Rough BSON sizes: an array element is a key, a type byte and a value
+        new_frames = [frame for frame in set(frames) if frame not in frame_index]
+        entry_size = 40 + 12 * len(frames) + sum(len(frame) + 12 for frame in new_frames)
+        full = max_stacks is not None and len(entries) >= max_stacks
+        if full or (max_bytes is not None and size + entry_size > max_bytes):
+            omitted_samples += count
+            continue
+        for frame in frames:
+            frame_index.setdefault(frame, len(frame_index))
+        entries.append({"frames": [frame_index[frame] for frame in frames], "count": count})
+        size += entry_size
+    return list(frame_index), entries, omitted_samples
+
+
+def expand_stacks(profile):
+    """{stack: count} from a profile document, with interned or (older) plain stacks"""
+    stacks = {}
+    for entry in profile["stacks"]:
+        if "frames" in entry:
+            stack = ";".join(profile["frames"][index] for index in entry["frames"])
+        else:
+            stack = entry["stack"]
+        stacks[stack] = stacks.get(stack, 0) + entry["count"]
+    return stacks
+
+
+def write_collapsed(stacks, fp):
+    """Write {stack: count} in the collapsed-stack text format"""
+    for stack, count in sorted(stacks.items(), key=lambda item: -item[1]):
+        fp.write(f"{stack} {count}\n")
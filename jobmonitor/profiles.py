@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+import sys
+from argparse import ArgumentParser
+
+from bson.objectid import ObjectId
+
+from jobmonitor.profiler import expand_stacks, write_collapsed
+
+
+"""
+Show the results of a job that ran with `jobrun --profile`
+"""
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("job_id", help="ID of the job")
+    parser.add_argument("--worker", "-w", type=int, help="Which worker? default: all combined")
+    parser.add_argument("--top", "-n", type=int, default=25, help="Number of functions to show")
+    parser.add_argument(
+        "--collapsed",
+        "-c",
+        default=False,
+        action="store_true",
+        help="Print collapsed stacks, for flamegraph.pl or speedscope",
+    )
+    args = parser.parse_args()
+
+    from jobmonitor.connections import mongo_reader as mongo
+
+    query = {"job_id": ObjectId(args.job_id)}
+    if args.worker is not None:
+        query["worker"] = args.worker
+    profiles = list(mongo.profile.find(query).sort("worker", 1))
+
+    if not profiles:
+        print("No profile found for this job. Was it started with `jobrun --profile`?")
+        sys.exit(1)
+
+    stacks = {}
+    for profile in profiles:
+        for stack, count in expand_stacks(profile).items():
+            stacks[stack] = stacks.get(stack, 0) + count
+
+    if args.collapsed:
+        write_collapsed(stacks, sys.stdout)
+        return
+
+    for profile in profiles:
+        omitted = profile.get("omitted_samples", 0)
+        print(
+            f"Worker {profile['worker']}: "
+            f"{profile['samples']} samples in {profile['duration']:.0f}s, "
+            f"sampler overhead {100 * profile['overhead']:.2f}%"
+            + (f", {omitted} samples in rare stacks omitted" if omitted else "")
+        )
+    print()
+
+    # Self: the function was running. Total: the function was on the stack.
+    self_counts = {}
+    total_counts = {}
+    for stack, count in stacks.items():
+        frames = stack.split(";")
+        self_counts[frames[-1]] = self_counts.get(frames[-1], 0) + count
+        for frame in set(frames):
+            total_counts[frame] = total_counts.get(frame, 0) + count
+
+    n_samples = sum(stacks.values())
+    top = sorted(total_counts, key=lambda frame: -self_counts.get(frame, 0))[: args.top]
+    print(f"{'self':>7} {'total':>7}  function")
+    for frame in top:
+        self_percent = 100 * self_counts.get(frame, 0) / n_samples
+        total_percent = 100 * total_counts[frame] / n_samples
+        print(f"{self_percent:>6.1f}% {total_percent:>6.1f}%  {frame}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+"""
+Finds RUNNING jobs with workers that stopped sending heartbeats, marks them as
+UNRESPONSIVE (or FAILED) or puts them back in the queue, and releases their queue slots.
+Workers that are still alive in such a job notice the status change and stop.
+
+    jobreaper                       # once
+    jobreaper --interval 60         # keep running, e.g. next to the database
+    jobreaper --requeue --dry-run   # only show which jobs would be requeued
+"""
+
+import datetime
+import sys
+from argparse import ArgumentParser
+from time import sleep
+
+from pymongo import UpdateOne
+
+from jobmonitor import job_queue
+from jobmonitor.lazy_loader import LazyLoader
+
+c = LazyLoader("c", globals(), "jobmonitor.connections")
+
+# A worker counts as dead when its last heartbeat is older than this many seconds.
+# Workers send a heartbeat every 10 seconds.
+DEAD_AFTER = 300
+
+# With --requeue, a job is put back in the queue at most this many times, and marked after that
+MAX_REQUEUES = 3
+
+
+def find_dead_jobs(dead_after=DEAD_AFTER):
+    """RUNNING jobs with silent workers, with the ranks of those workers in `dead_workers`"""
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=dead_after)
+    # Workers that did not send a heartbeat yet count from the start of the job
+    worker_heartbeat = {"$ifNull": ["$$worker.v.last_heartbeat_time", "$start_time"]}
+    pipeline = [
+        {"$match": {"status": "RUNNING"}},
+        {
+            "$project": {
+                "project": 1,
+                "experiment": 1,
+                "job": 1,
+                "n_workers": 1,
+                "priority": 1,
+                "creation_time": 1,
+                "requeue_count": 1,
+                "dead_workers": {
+                    "$map": {
+                        "input": {
+                            "$filter": {
+                                "input": {
+                                    "$objectToArray": {"$ifNull": ["$workers", {"$literal": {}}]}
+                                },
+                                "as": "worker",
+                                # Workers that finished their part don't send heartbeats
+                                "cond": {
+                                    "$and": [
+                                        {"$lt": [worker_heartbeat, cutoff]},
+                                        {"$eq": [{"$ifNull": ["$$worker.v.end_time", None]}, None]},
+                                    ]
+                                },
+                            }
+                        },
+                        "as": "worker",
+                        "in": "$$worker.k",
+                    }
+                },
+                # Jobs from before per-worker heartbeats
+                "silent": {
+                    "$lt": [{"$ifNull": ["$last_heartbeat_time", "$start_time"]}, cutoff]
+                },
+            }
+        },
+        {"$match": {"$or": [{"dead_workers.0": {"$exists": True}}, {"silent": True}]}},
+    ]
+    return list(c.mongo.job.aggregate(pipeline))
+
+
+def reap(jobs, mark_as="UNRESPONSIVE", requeue=False, max_requeues=MAX_REQUEUES):
+    """
+    Mark `jobs` from `find_dead_jobs` in one bulk write, or requeue them, and release their slots.
+    Returns the ids of the requeued jobs.
+    """
+    now = datetime.datetime.utcnow()
+    marked_operations = []
+    marked_job_ids = []
+    requeued_job_ids = []
+    for job in jobs:
+        # Only if the job didn't end or get requeued in the meantime
+        query = {"_id": job["_id"], "status": "RUNNING"}
+        if requeue and job.get("requeue_count", 0) < max_requeues:
+            result = c.mongo.job.update_one(
+                query,
+                {
+                    "$set": {"status": "CREATED", "registered_workers": 0},
+                    "$unset": {
+                        "barrier": "",
+                        "workers": "",
+                        "host": "",
+                        "start_time": "",
+                        "last_heartbeat_time": "",
+                    },
+                    "$inc": {"requeue_count": 1},
+                },
+            )
+            if result.modified_count == 1:
+                job_queue.dequeue_job(job["_id"])
+                job_queue.enqueue_job(
+                    job["_id"], job["n_workers"], job["priority"], job["creation_time"]
+                )
+                requeued_job_ids.append(job["_id"])
+        else:
+            marked_operations.append(
+                UpdateOne(
+                    query,
+                    {
+                        "$set": {
+                            "status": mark_as,
+                            "end_time": now,
+                            "exception": f"No heartbeat from {_describe_dead_workers(job)}",
+                        }
+                    },
+                )
+            )
+            marked_job_ids.append(job["_id"])
+
+    if marked_operations:
+        c.mongo.job.bulk_write(marked_operations, ordered=False)
+        # The slots of a running job are started. Fresh slots of a job that was requeued
+        # in the meantime are not, and stay.
+        c.mongo.job_queue.delete_many({"job_id": {"$in": marked_job_ids}, "started": True})
+    return requeued_job_ids
+
+
+def _describe_dead_workers(job):
+    ranks = sorted(job["dead_workers"], key=int)
+    return "workers " + ", ".join(ranks) if ranks else "any worker"
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--dead-after",
+        type=float,
+        default=DEAD_AFTER,
+        help=f"seconds without heartbeat after which a worker counts as dead, default {DEAD_AFTER}",
+    )
+    parser.add_argument("--mark-as", choices=["UNRESPONSIVE", "FAILED"], default="UNRESPONSIVE")
+    parser.add_argument(
+        "--requeue", default=False, action="store_true", help="Put dead jobs back in the queue."
+    )
+    parser.add_argument("--max-requeues", type=int, default=MAX_REQUEUES)
+    parser.add_argument("--interval", type=float, default=None, help="Repeat every n seconds.")
+    parser.add_argument("--dry-run", default=False, action="store_true")
+    args = parser.parse_args()
+
+    while True:
+        jobs = find_dead_jobs(args.dead_after)
+        for job in jobs:
+            will_requeue = args.requeue and job.get("requeue_count", 0) < args.max_requeues
+            print(
+                f"- {job.get('experiment')} / {job.get('job')} ({job['_id']}) -- "
+                f"no heartbeat from {_describe_dead_workers(job)} "
+                f"-> {'requeue' if will_requeue else args.mark_as}"
+            )
+        if not args.dry_run:
+            reap(jobs, args.mark_as, args.requeue, args.max_requeues)
+            n_released = job_queue.release_orphaned_slots()
+            if n_released:
+                print(f"Released {n_released} queue slots of jobs that are no longer active.")
+            n_failed = job_queue.fail_exhausted_jobs()
+            if n_failed:
+                print(f"Marked {n_failed} jobs FAILED, their workers kept dying before the start.")
+
+        if args.interval is None:
+            break
+        sys.stdout.flush()
+        sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
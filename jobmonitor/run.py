@@ -3,25 +3,44 @@
 import datetime
 import hashlib
 import json
+import multiprocessing
 import os
 import re
 import shutil
 import signal
 import socket
+import stat
 import sys
+import threading
 import traceback
 from argparse import ArgumentParser
+from contextlib import contextmanager
 from importlib import import_module
 from pprint import pprint
-from time import sleep
+from time import perf_counter, sleep, time
 
 import yaml
 from bson.objectid import ObjectId
-from pymongo import ASCENDING, DESCENDING
-
-from jobmonitor.api import download_code_package, job_by_id, update_job
-from jobmonitor.connections import mongo
-from jobmonitor.utils import IntervalTimer
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import OperationFailure
+from pymongo.write_concern import WriteConcern
+
+from jobmonitor import code_cache, heartbeat, job_queue
+from jobmonitor.api import (
+    LOG_BUCKET_INDEXES,
+    LOG_BUCKET_SIZE,
+    METRIC_BUCKET_INDEX,
+    METRIC_BUCKET_SIZE,
+    download_code_package,
+    job_by_id,
+    update_job,
+)
+from jobmonitor.histogram import LatencyHistogram
+from jobmonitor.lazy_loader import LazyLoader
+from jobmonitor.profiler import SamplingProfiler, intern_stacks, write_collapsed
+from jobmonitor.utils import BackgroundFlusher, IntervalTimer, file_sha256, reflink
+
+c = LazyLoader("c", globals(), "jobmonitor.connections")
 
 """
 This script takes a job_id and it looks in MongoDB for a job with that ID.
@@ -52,6 +71,59 @@ It will
 
 is_stopping = False
 
+# Lines printed by a job are sent to MongoDB in batches of at most this many lines,
+# and at least every LOG_FLUSH_INTERVAL seconds
+LOG_BUFFER_LINES = 256
+LOG_FLUSH_INTERVAL = 0.5
+
+# Metric data points are written to MongoDB in one bulk write every METRIC_FLUSH_INTERVAL
+# seconds, or earlier when more than METRIC_BUFFER_POINTS points are waiting
+METRIC_BUFFER_POINTS = 10_000
+METRIC_FLUSH_INTERVAL = 1.0
+
+# Durations recorded with `log_timing` are added to the job's histograms every this many seconds
+TIMING_FLUSH_INTERVAL = 10.0
+
+# Where metric data points are stored:
+# "bucket" (separate `metric_bucket` collection) or "job" (`metric_data` in the job document)
+METRIC_STORAGE = os.getenv("JOBMONITOR_METRIC_STORAGE", "bucket")
+
+# Where log lines are stored:
+# "bucket" (separate `log_bucket` collection) or "job" (`logs` in the job document)
+LOG_STORAGE = os.getenv("JOBMONITOR_LOG_STORAGE", "bucket")
+
+
+# An idle queue worker checks for new jobs after QUEUE_MIN_BACKOFF seconds,
+# doubling the wait up to QUEUE_MAX_BACKOFF seconds. New jobs wake it up earlier.
+QUEUE_MIN_BACKOFF = 1
+QUEUE_MAX_BACKOFF = 60
+
+# Workers that take any job look for waiting jobs that are missing from the job queue, e.g.
+# older jobs or jobs that were set back to CREATED, at most every ENQUEUE_WAITING_INTERVAL seconds
+ENQUEUE_WAITING_INTERVAL = 60
+_last_enqueue_waiting = None
+
+# How "path" clones populate a job's code directory:
+# "sync" (only copy files whose size or modification time changed, keep the rest),
+# "checksum" (like sync, but files with a different modification time are compared by content),
+# or "copy" (delete the directory and copy everything)
+CLONE_MODE = os.getenv("JOBMONITOR_CLONE_MODE", "sync")
+
+# New files are copy-on-write clones where the filesystem supports it, and copies otherwise.
+# Set to 1 to hardlink them instead of copying. Edits to the source then show up in running jobs.
+CLONE_HARDLINKS = os.getenv("JOBMONITOR_CLONE_HARDLINKS", "0") == "1"
+
+# With --profile, the stack of the worker's main thread is sampled every PROFILE_INTERVAL seconds,
+# or less often if sampling would take more than PROFILE_MAX_OVERHEAD of the time.
+# Results are written every PROFILE_FLUSH_INTERVAL seconds. The database keeps the most
+# frequent PROFILE_MAX_STACKS stacks, in at most about PROFILE_MAX_BYTES, so profiles stay
+# below MongoDB's 16 MB document limit. The file in the output directory has all of them.
+PROFILE_INTERVAL = 0.01
+PROFILE_MAX_OVERHEAD = 0.01
+PROFILE_FLUSH_INTERVAL = 60
+PROFILE_MAX_STACKS = 5000
+PROFILE_MAX_BYTES = 8 * 1024 * 1024
+
 
 # Raise SystemExit when SIGTERM is received
 signal.signal(signal.SIGTERM, lambda signo, stack_frame: sys.exit(1))
@@ -78,61 +150,164 @@ def main():
             "Only appliccable in queue mode."
         ),
     )
+    parser.add_argument(
+        "--max-jobs",
+        type=int,
+        default=None,
+        help="Stop after running this many jobs. Only applicable in queue mode.",
+    )
+    parser.add_argument(
+        "--max-idle-time",
+        type=float,
+        default=None,
+        help=(
+            "Stop when the queue stayed empty for this many seconds. "
+            "Only applicable in queue mode."
+        ),
+    )
     parser.add_argument(
         "--mpi", default=False, action="store_true", help="Derive rank and world_size from MPI"
     )
+    parser.add_argument(
+        "--profile",
+        default=False,
+        action="store_true",
+        help="Run a sampling profiler, see `jobprofile`. Jobs can also set environment.profile.",
+    )
     args = parser.parse_args()
 
-    # Retrieve the job description
     if args.queue_mode:
-        query = {
-            "$expr": {"$lt": ["$registered_workers", "$n_workers"]},
-            "status": {"$in": ["SCHEDULED", "CREATED"]},
-        }
-        if args.min_worker_count is not None:
-            query["n_workers"] = {"$gte": args.min_worker_count}
-        if args.job_id != ["any"]:
-            query["_id"] = {"$in": [ObjectId(id) for id in args.job_id]}
+        queue_worker(args)
+    else:
+        claimed = claim_job(job_ids=args.job_id[:1])
+        if claimed is None:
+            print("Job not found / nothing to do.")
+            sys.exit(0)
+        job, rank = claimed
+        run_job(job, rank, mpi=args.mpi, profile=args.profile)
 
-        job = mongo.job.find_one_and_update(
-            query,
-            update={
-                "$set": {"status": "SCHEDULED", "schedule_time": datetime.datetime.utcnow()},
-                "$inc": {"registered_workers": 1},
-            },
-            sort=[("priority", DESCENDING), ("creation_time", ASCENDING)],
-        )
-        if job is None:
-            print("Queue is empty. Waiting for a task.")
-            sleep(10)
-            return main()
 
-        job_id = str(job["_id"])
-    else:
-        job = mongo.job.find_one_and_update(
-            {
-                "_id": ObjectId(args.job_id[0]),
-                "$expr": {"$lt": ["$registered_workers", "$n_workers"]},
-                "status": {"$in": ["SCHEDULED", "CREATED"]},
-            },
+def claim_job(job_ids=None, min_worker_count=None):
+    """
+    Lease a worker slot of the highest-priority job that needs workers, see `job_queue`.
+    Returns the job and this worker's rank, or None if there is nothing to do.
+    """
+    global _last_enqueue_waiting
+    while True:
+        slot = job_queue.claim_slot(job_ids, min_worker_count)
+        if slot is None:
+            job_queue.fail_exhausted_jobs()
+            # Waiting jobs may not be in the queue yet, e.g. older jobs
+            if job_ids is not None:
+                if job_queue.enqueue_waiting_jobs(job_ids) > 0:
+                    continue
+            elif (
+                _last_enqueue_waiting is None
+                or time() - _last_enqueue_waiting > ENQUEUE_WAITING_INTERVAL
+            ):
+                _last_enqueue_waiting = time()
+                if job_queue.enqueue_waiting_jobs() > 0:
+                    continue
+            return None
+        job = c.mongo.job.find_one_and_update(
+            {"_id": slot["job_id"], "status": {"$in": ["SCHEDULED", "CREATED"]}},
             update={
                 "$set": {"status": "SCHEDULED", "schedule_time": datetime.datetime.utcnow()},
-                "$inc": {"registered_workers": 1},
+                "$max": {"registered_workers": slot["rank"] + 1},
             },
-            sort=[("priority", DESCENDING), ("creation_time", ASCENDING)],
+            projection={"logs": 0, "metric_data": 0, "workers": 0, "metrics": 0},
+            return_document=ReturnDocument.AFTER,
         )
-        if job is None:
-            print("Job not found / nothing to do.")
-            sys.exit(0)
-        job_id = str(job["_id"])
+        if job is not None:
+            return job, slot["rank"]
+        # The job was canceled or deleted while it was waiting
+        c.mongo.job_queue.delete_one({"_id": slot["_id"]})
+
+
+def queue_worker(args):
+    """
+    Keep claiming jobs from the queue and run them one after the other,
+    each in a fresh child process, until `--max-jobs` jobs ran
+    or the queue stayed empty for `--max-idle-time` seconds.
+    """
+    job_ids = None if args.job_id == ["any"] else args.job_id
+
+    jobs_done = 0
+    idle_since = time()
+    backoff = QUEUE_MIN_BACKOFF
+    while args.max_jobs is None or jobs_done < args.max_jobs:
+        claimed = claim_job(job_ids, args.min_worker_count)
+        if claimed is None:
+            if args.max_idle_time is not None and time() - idle_since > args.max_idle_time:
+                print("Queue stayed empty for too long. Stopping.")
+                return
+            print(f"Queue is empty. Waiting for a task (at most {backoff:.0f}s).")
+            wait_for_new_jobs(backoff)
+            backoff = min(2 * backoff, QUEUE_MAX_BACKOFF)
+            continue
+
+        backoff = QUEUE_MIN_BACKOFF
+        job, rank = claimed
+        process = multiprocessing.get_context("fork").Process(
+            target=_run_job_in_child, args=(job, rank, args.mpi, args.profile)
+        )
+        process.start()
+        try:
+            process.join()
+        finally:
+            # If this worker is stopped (e.g. SIGTERM), pass it on to the job
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        print(f"Job {job['_id']} exited with code {process.exitcode}")
+        jobs_done += 1
+        idle_since = time()
+
+
+def wait_for_new_jobs(timeout):
+    """Sleep until a job is added to the queue, or until `timeout` seconds passed"""
+    pipeline = [{"$match": {"operationType": "insert"}}]
+    try:
+        with c.mongo.job_queue.watch(pipeline, max_await_time_ms=int(timeout * 1000)) as stream:
+            stream.try_next()
+    except OperationFailure:
+        # Standalone servers don't support change streams
+        sleep(timeout)
+
+
+def _run_job_in_child(job, rank, mpi, profile):
+    global _cancellation_watcher
+    # Threads don't survive a fork
+    _cancellation_watcher = None
+    run_job(job, rank, mpi, profile)
+
+
+def run_job(job, rank, mpi=False, profile=False):
+    """Run a job in the worker slot with `rank` that this worker leased, see `claim_job`"""
+    global is_stopping
 
-    if not args.mpi:
-        rank = job["registered_workers"]
+    profile = profile or job["environment"].get("profile", False)
+
+    job_id = str(job["_id"])
+
+    # The queue slot this worker leased. With MPI, the worker's rank can differ from the slot's.
+    lease_rank = rank
+    if not mpi:
         n_workers = job["n_workers"]
     else:
         rank = int(os.getenv("OMPI_COMM_WORLD_RANK", os.getenv("PMIX_RANK")))
         n_workers = int(os.getenv("OMPI_COMM_WORLD_SIZE", os.getenv("SLURM_NTASKS")))
 
+    def side_thread_fn():
+        if is_stopping:
+            return
+        send_heartbeat(job_id, rank, lease_rank)
+
+    # Start sending regular heartbeat updates to the db. They also renew this worker's
+    # lease on its queue slot, already while it clones the code and waits for the others.
+    side_thread_stop, side_thread = IntervalTimer.create(side_thread_fn, 10)
+    side_thread.start()
+
     # Create an output directory
     output_dir = os.path.join(
         job["project"], job["experiment"], job["job"] + "_" + str(job["_id"])[-6:]
@@ -151,7 +326,10 @@ def main():
             )
             clone_directory(clone_from, code_dir)
         elif "code_package" in clone_info:
-            download_code_package(clone_info["code_package"], code_dir)
+            if code_cache.is_enabled():
+                code_cache.fetch_code_package(clone_info["code_package"], code_dir)
+            else:
+                download_code_package(clone_info["code_package"], code_dir)
         else:
             raise ValueError('Current, only the "path" clone approach is supported')
 
@@ -161,7 +339,7 @@ def main():
     )
 
     # Wait for all the workers to reach this point
-    barrier("jobstart", job_id, n_workers, desired_statuses=["SCHEDULED", "RUNNING"])
+    barrier("jobstart", job_id, rank, n_workers, desired_statuses=["SCHEDULED", "RUNNING"])
 
     # Somehow the output directory doesn't seem to exist on all workers.
     # Maybe it needs a little sleep.
@@ -169,6 +347,8 @@ def main():
 
     # Set job to 'RUNNING' in MongoDB
     if rank == 0:
+        # From now on, slots whose lease expires are not offered to other workers
+        job_queue.mark_started(job_id)
         update_job(
             job_id,
             {
@@ -179,35 +359,22 @@ def main():
             },
         )
 
-    def side_thread_fn():
-        global is_stopping
+    # Buffered MongoDB writers (logs, metrics) that need to be drained before the worker exits
+    buffered_writers = []
+
+    def close_buffered_writers():
+        while buffered_writers:
+            buffered_writers.pop().close()
+
+    def on_cancel(job_id, status):
         if is_stopping:
             return
-        # Check the status of the job and if we need to self-destruct
-        res = mongo.job.find_one({"_id": ObjectId(job_id)}, {"status": 1})
-        if res is None or res["status"] not in ["SCHEDULED", "RUNNING", "FINISHED"]:
-            status = res["status"] if res is not None else "DELETED"
-            print(
-                f"Job status changed to {status}. This worker will self-destruct.", file=sys.stderr
-            )
-            os._exit(1)
-            # os.system("kill %d" % os.getpid())
-            is_stopping = True
+        print(f"Job status changed to {status}. This worker will self-destruct.", file=sys.stderr)
+        close_buffered_writers()
+        os._exit(1)
 
-        # Update the worker's heartbeat
-        update_job(
-            job_id,
-            {
-                "last_heartbeat_time": datetime.datetime.utcnow(),
-                f"workers.{rank}.last_heartbeat_time": datetime.datetime.utcnow(),
-            },
-            w=0,
-        )
-
-    # Start sending regular heartbeat updates to the db
-    # and check whether the job isn't getting canceled
-    side_thread_stop, side_thread = IntervalTimer.create(side_thread_fn, 10)
-    side_thread.start()
+    # Check whether the job isn't getting canceled
+    get_cancellation_watcher().add(job_id, on_cancel)
 
     try:
         # Change directory to the right directory
@@ -223,16 +390,27 @@ def main():
         print("Starting. Output piped to {}".format(logfile_path))
         orig_stdout = sys.stdout
         orig_stderr = sys.stderr
-        sys.stdout = MultiLogChannel(
-            MongoLogChannel(mongo.job, job_id, tags={"worker": rank, "type": "info"}),
-            sys.stdout,
-            FileLogChannel(logfile),
-        )
-        sys.stderr = MultiLogChannel(
-            MongoLogChannel(mongo.job, job_id, tags={"worker": rank, "type": "error"}),
-            sys.stderr,
-            FileLogChannel(logfile),
-        )
+        if LOG_STORAGE == "bucket":
+            if rank == 0:
+                for index in LOG_BUCKET_INDEXES:
+                    c.mongo.log_bucket.create_index(index)
+            log_bucket_collection = c.mongo.log_bucket
+        else:
+            log_bucket_collection = None
+        info_channel, error_channel = [
+            MongoLogChannel(
+                c.mongo.job,
+                job_id,
+                tags={"worker": rank, "type": log_type},
+                buffer_lines=LOG_BUFFER_LINES,
+                flush_interval=LOG_FLUSH_INTERVAL,
+                bucket_collection=log_bucket_collection,
+            )
+            for log_type in ["info", "error"]
+        ]
+        buffered_writers.extend([info_channel, error_channel])
+        sys.stdout = MultiLogChannel(info_channel, sys.stdout, FileLogChannel(logfile))
+        sys.stderr = MultiLogChannel(error_channel, sys.stderr, FileLogChannel(logfile))
 
         print("cwd: {}".format(code_dir))
 
@@ -270,38 +448,69 @@ def main():
                 w=0,
             )
 
-        # keep track of which metrics already got an entry in MongoDB
-        metrics_created_so_far = set()
-
-        def log_metric(measurement, value, tags={}):
-            # Log the metric to MongoDB
-            if not isinstance(value, dict):
-                value = {"value": value}
+        # Records single durations, e.g. of every training step, in latency histograms
+        timing_buffer = TimingBuffer(c.mongo.job, job_id, rank, TIMING_FLUSH_INTERVAL)
+        buffered_writers.append(timing_buffer)
+
+        def log_timing(event, seconds):
+            timing_buffer.record(event.replace(".", "_"), seconds)
+
+        @contextmanager
+        def timed(event):
+            start = perf_counter()
+            try:
+                yield
+            finally:
+                log_timing(event, perf_counter() - start)
+
+        if METRIC_STORAGE == "bucket":
+            if rank == 0:
+                c.mongo.metric_bucket.create_index(METRIC_BUCKET_INDEX)
+            metric_bucket_collection = c.mongo.metric_bucket
+        else:
+            metric_bucket_collection = None
+        metric_buffer = MetricBuffer(
+            c.mongo.job,
+            job_id,
+            bucket_collection=metric_bucket_collection,
+            max_points=METRIC_BUFFER_POINTS,
+            flush_interval=METRIC_FLUSH_INTERVAL,
+        )
+        buffered_writers.append(metric_buffer)
 
-            values = {"time": datetime.datetime.utcnow(), **value}
-            key_dict = {"measurement": measurement, **tags}
+        log_metric = metric_logger(metric_buffer, rank, n_workers)
 
-            if n_workers > 1:
-                key_dict["worker"] = rank
+        # Allows the script to force buffered metrics out to the database
+        def flush_metrics():
+            metric_buffer.flush()
 
-            key_hash = hashlib.md5(json.dumps(key_dict, sort_keys=True).encode("utf-8")).hexdigest()
+        # Allows the script to synchronize all workers of the job, e.g. before evaluation.
+        # Barriers can be reused: the n-th use of a name waits until every worker used it n times.
+        barrier_uses = {}
 
-            if not key_hash in metrics_created_so_far:
-                metrics_created_so_far.add(key_hash)
-                mongo.job.update(
-                    {"_id": ObjectId(job_id)},
-                    {"$push": {f"metrics": {**key_dict, "id": key_hash}}},
-                    w=0,
-                )
-            mongo.job.update(
-                {"_id": ObjectId(job_id)}, {"$push": {f"metric_data.{key_hash}": values}}, w=0
+        def worker_barrier(name):
+            if n_workers == 1:
+                return
+            name = name.replace(".", "_")
+            barrier_uses[name] = barrier_uses.get(name, 0) + 1
+            barrier(
+                f"script_{name}",
+                job_id,
+                rank,
+                n_workers,
+                generation=barrier_uses[name],
+                desired_statuses=["SCHEDULED", "RUNNING"],
             )
 
         script.log_info = log_info
         script.log_image = log_image
         script.output_dir = output_dir_abs
         script.log_metric = log_metric
+        script.flush_metrics = flush_metrics
         script.log_runtime = log_runtime
+        script.log_timing = log_timing
+        script.timed = timed
+        script.barrier = worker_barrier
 
         if rank == 0:
             # Store the effective config used in the database
@@ -310,15 +519,29 @@ def main():
             with open(os.path.join(output_dir_abs, "config.yml"), "w") as fp:
                 yaml.dump(dict(script.config), fp, default_flow_style=False)
 
+        if profile:
+            profile_file = os.path.join(output_dir_abs, f"profile.worker{rank}.txt")
+            buffered_writers.append(start_profiler(job_id, rank, profile_file))
+
         # Run the task
         script.main()
 
-        # Finished successfully
+        # Make sure all metrics are in the database before the job is marked as finished
+        metric_buffer.flush()
+        timing_buffer.flush()
+
+        # Finished successfully. Workers that are done stop sending heartbeats,
+        # this keeps the reaper from taking them for dead while the others continue.
+        update_job(job_id, {f"workers.{rank}.end_time": datetime.datetime.utcnow()})
         if rank == 0:
             print("Job finished successfully")
             update_job(job_id, {"status": "FINISHED", "end_time": datetime.datetime.utcnow()})
+            job_queue.dequeue_job(job_id)
 
     except Exception as e:
+        # Our own status change below should not trigger a self-destruct
+        is_stopping = True
+        get_cancellation_watcher().remove(job_id)
         error_message = traceback.format_exc()
         print(error_message, file=sys.stderr)
         if isinstance(e, KeyboardInterrupt) or isinstance(e, SystemExit):
@@ -335,16 +558,17 @@ def main():
                 "exception_worker": rank,
             },
         )
-        global is_stopping
-        is_stopping = True
+        job_queue.dequeue_job(job_id)
         sys.stdout = orig_stdout
         sys.stderr = orig_stderr
         side_thread_stop.set()
         side_thread.join(timeout=1)
         sys.exit(1)
     finally:
-        global is_stopping
         is_stopping = True
+        get_cancellation_watcher().remove(job_id)
+        # Write out any buffered log lines and metrics (also on SystemExit / KeyboardInterrupt)
+        close_buffered_writers()
         # Stop the heartbeat thread
         sys.stdout = orig_stdout
         sys.stderr = orig_stderr
@@ -352,12 +576,100 @@ def main():
         side_thread.join(timeout=1)
 
 
-def clone_directory(from_directory, to_directory, overwrite=True):
+def send_heartbeat(job_id, rank, lease_rank=None):
+    """
+    Update the worker's heartbeat and renew its lease on the queue slot `lease_rank`
+    (by default the slot of `rank`), through the node's heartbeat agent if possible
+    """
+    if lease_rank is None:
+        lease_rank = rank
+    if heartbeat.send(job_id, rank, lease_rank):
+        return
+    job_queue.renew_lease(job_id, lease_rank, w=0)
+    update_job(
+        job_id,
+        {
+            "last_heartbeat_time": datetime.datetime.utcnow(),
+            f"workers.{rank}.last_heartbeat_time": datetime.datetime.utcnow(),
+        },
+        w=0,
+    )
+
+
+def metric_logger(metric_buffer, rank, n_workers):
+    """The `log_metric(measurement, value, tags={})` function that scripts get"""
+
+    def log_metric(measurement, value, tags={}):
+        # Log the metric to MongoDB
+        if not isinstance(value, dict):
+            value = {"value": value}
+
+        values = {"time": datetime.datetime.utcnow(), **value}
+        key_dict = {"measurement": measurement, **tags}
+
+        if n_workers > 1:
+            key_dict["worker"] = rank
+
+        key_hash = hashlib.md5(json.dumps(key_dict, sort_keys=True).encode("utf-8")).hexdigest()
+
+        metric_buffer.add(key_hash, key_dict, values)
+
+    return log_metric
+
+
+def start_profiler(job_id, rank, output_file):
+    """Sample the calling thread, results go to `output_file` and the `profile` collection"""
+
+    def write_profile(snapshot):
+        with open(output_file, "w") as fp:
+            write_collapsed(snapshot["stacks"], fp)
+        frames, stacks, omitted_samples = intern_stacks(
+            snapshot["stacks"], max_stacks=PROFILE_MAX_STACKS, max_bytes=PROFILE_MAX_BYTES
+        )
+        c.mongo.profile.replace_one(
+            {"job_id": ObjectId(job_id), "worker": rank},
+            {
+                "job_id": ObjectId(job_id),
+                "worker": rank,
+                "update_time": datetime.datetime.utcnow(),
+                "samples": snapshot["samples"],
+                "duration": snapshot["duration"],
+                "interval": snapshot["interval"],
+                "overhead": snapshot["overhead"],
+                # Stacks are lists of indices in `frames`
+                "frames": frames,
+                "stacks": stacks,
+                "omitted_samples": omitted_samples,
+            },
+            upsert=True,
+        )
+
+    profiler = SamplingProfiler(
+        threading.get_ident(),
+        interval=PROFILE_INTERVAL,
+        max_overhead=PROFILE_MAX_OVERHEAD,
+        on_flush=write_profile,
+        flush_interval=PROFILE_FLUSH_INTERVAL,
+    )
+    profiler.start()
+    print(f"Profiling, results are written to {output_file}")
+    return profiler
+
+
+def clone_directory(from_directory, to_directory, overwrite=True, mode=None):
+    """
+    Copy a directory, skipping the patterns in its .jobignore file.
+    An existing `to_directory` is brought up to date according to `mode` (default: CLONE_MODE).
+    """
+    mode = mode or CLONE_MODE
+    if mode not in ["sync", "checksum", "copy"]:
+        raise ValueError(f"Unknown clone mode {mode}")
+
     if os.path.isdir(to_directory):
-        if overwrite:
-            shutil.rmtree(to_directory)
-        else:
+        if not overwrite:
             raise RuntimeError("Cannot clone to an existing directory.")
+        elif mode == "copy":
+            shutil.rmtree(to_directory)
 
     # detect .jobignore file to skip certain patterns
     ignore_file = os.path.join(from_directory, ".jobignore")
@@ -368,37 +680,272 @@ def clone_directory(from_directory, to_directory, overwrite=True):
     else:
         ignore_patterns = None
 
-    shutil.copytree(from_directory, to_directory, ignore=ignore_patterns)
+    if mode == "copy":
+        shutil.copytree(from_directory, to_directory, ignore=ignore_patterns)
+    else:
+        _sync_directory(from_directory, to_directory, ignore_patterns, checksum=mode == "checksum")
+
+
+def _sync_directory(from_directory, to_directory, ignore_patterns, checksum=False):
+    """Make `to_directory` equal to `from_directory`, touching only what changed"""
+    copy_functions = [reflink, os.link, shutil.copy2]
+    if not CLONE_HARDLINKS:
+        copy_functions.remove(os.link)
+
+    # Like copytree, this follows symlinks and copies what they point to
+    for root, dirs, files in os.walk(from_directory, followlinks=True):
+        ignored = ignore_patterns(root, dirs + files) if ignore_patterns else set()
+        dirs[:] = [name for name in dirs if name not in ignored]
+        files = [name for name in files if name not in ignored]
+
+        target_root = os.path.join(to_directory, os.path.relpath(root, from_directory))
+        os.makedirs(target_root, exist_ok=True)
+
+        # Remove what is not in the source (anymore), or has changed from file to directory
+        for name in os.listdir(target_root):
+            target = os.path.join(target_root, name)
+            is_directory = os.path.isdir(target) and not os.path.islink(target)
+            if name in dirs and is_directory or name in files and not is_directory:
+                continue
+            if is_directory:
+                shutil.rmtree(target)
+            else:
+                os.remove(target)
+
+        for name in files:
+            source = os.path.join(root, name)
+            target = os.path.join(target_root, name)
+            if _is_same_file(source, target, checksum):
+                continue
+            if os.path.lexists(target):
+                os.remove(target)
+            # Find out what the filesystems support on the first file that is copied
+            for copy_fn in list(copy_functions):
+                try:
+                    copy_fn(source, target)
+                    break
+                except OSError:
+                    if copy_fn == shutil.copy2:
+                        raise
+                    copy_functions.remove(copy_fn)
+                    if os.path.lexists(target):
+                        os.remove(target)
+
+
+def _is_same_file(source, target, checksum):
+    try:
+        source_stat = os.stat(source)
+        target_stat = os.lstat(target)
+    except FileNotFoundError:
+        return False
+    if not stat.S_ISREG(target_stat.st_mode) or source_stat.st_size != target_stat.st_size:
+        return False
+    if source_stat.st_mtime_ns == target_stat.st_mtime_ns:
+        return True
+    if checksum and file_sha256(source) == file_sha256(target):
+        shutil.copystat(source, target)
+        return True
+    return False
+
+
+class CancellationWatcher(threading.Thread):
+    """
+    Calls `on_cancel(job_id, status)` when a watched job gets a status other than
+    SCHEDULED, RUNNING or FINISHED, or when it is deleted (status "DELETED").
+    One watcher serves all jobs of a process: it follows a single change stream, filtered
+    to status changes of the watched jobs. On standalone MongoDB servers without change streams,
+    it checks all watched jobs with one query every `poll_interval` seconds.
+    """
+
+    active_statuses = ["SCHEDULED", "RUNNING", "FINISHED"]
+
+    def __init__(self, db, poll_interval=10):
+        threading.Thread.__init__(self, daemon=True)
+        self.db = db
+        self.poll_interval = poll_interval
+        self._callbacks = {}
+        self._lock = threading.Lock()
+        self._jobs_changed = threading.Event()
+
+    def add(self, job_id, on_cancel):
+        with self._lock:
+            self._callbacks[ObjectId(job_id)] = on_cancel
+        self._jobs_changed.set()
+
+    def remove(self, job_id):
+        with self._lock:
+            self._callbacks.pop(ObjectId(job_id), None)
+        self._jobs_changed.set()
+
+    def run(self):
+        use_change_stream = True
+        while True:
+            try:
+                if use_change_stream:
+                    use_change_stream = self._follow_change_stream()
+                else:
+                    self._check_jobs()
+                    sleep(self.poll_interval)
+            except Exception:
+                traceback.print_exc(file=sys.__stderr__)
+                sleep(self.poll_interval)
+
+    def _follow_change_stream(self):
+        """Follow status changes until the set of watched jobs changes"""
+        self._jobs_changed.clear()
+        with self._lock:
+            job_ids = list(self._callbacks)
+        if not job_ids:
+            self._jobs_changed.wait()
+            return True
+
+        pipeline = [
+            {
+                "$match": {
+                    "documentKey._id": {"$in": job_ids},
+                    "$or": [
+                        {"operationType": {"$in": ["delete", "replace"]}},
+                        {"updateDescription.updatedFields.status": {"$exists": True}},
+                    ],
+                }
+            }
+        ]
+        try:
+            stream = self.db.watch(pipeline, max_await_time_ms=1000)
+        except OperationFailure:
+            return False
+
+        with stream:
+            # Catch status changes from before the stream was opened
+            self._check_jobs(job_ids)
+            while not self._jobs_changed.is_set():
+                change = stream.try_next()
+                if change is None:
+                    continue
+                job_id = change["documentKey"]["_id"]
+                if change["operationType"] == "delete":
+                    self._on_status(job_id, "DELETED")
+                elif change["operationType"] == "replace":
+                    self._on_status(job_id, change["fullDocument"].get("status"))
+                else:
+                    self._on_status(job_id, change["updateDescription"]["updatedFields"]["status"])
+        return True
+
+    def _check_jobs(self, job_ids=None):
+        if job_ids is None:
+            with self._lock:
+                job_ids = list(self._callbacks)
+        if not job_ids:
+            return
+        statuses = {
+            res["_id"]: res["status"]
+            for res in self.db.find({"_id": {"$in": job_ids}}, {"status": 1})
+        }
+        for job_id in job_ids:
+            self._on_status(job_id, statuses.get(job_id, "DELETED"))
+
+    def _on_status(self, job_id, status):
+        if status in self.active_statuses:
+            return
+        with self._lock:
+            on_cancel = self._callbacks.pop(job_id, None)
+        if on_cancel is not None:
+            on_cancel(str(job_id), status)
+
 
+_cancellation_watcher = None
 
-def barrier(name, job_id, desired_count, poll_interval=2, desired_statuses=None):
-    """Wait for all workers to reach this point"""
-    if desired_count == 1:
+
+def get_cancellation_watcher():
+    """The process-wide CancellationWatcher, started on first use"""
+    global _cancellation_watcher
+    if _cancellation_watcher is None:
+        _cancellation_watcher = CancellationWatcher(c.mongo.job)
+        _cancellation_watcher.start()
+    return _cancellation_watcher
+
+
+def barrier(name, job_id, rank, n_workers, generation=1, poll_interval=2, desired_statuses=None):
+    """
+    Wait for all workers to reach this point for the `generation`-th time.
+    Workers record their arrival in the job's `barrier.<name>.<rank>` field and then wait for
+    a change stream to report that all `n_workers` ranks arrived. Ranks are counted once,
+    also when a worker that took over a dead worker's slot arrives again.
+    On standalone MongoDB servers without change streams, this polls every `poll_interval` seconds.
+    """
+    if n_workers == 1:
         return
 
     print(f"Reached barrier {name}")
-    # Report that we reached this point
     query = {"_id": ObjectId(job_id)}
-    mongo.job.find_one_and_update(query, update={"$inc": {f"barrier.{name}": 1}})
+
+    # Open the change stream before reporting, so we can't miss the other workers' updates
+    try:
+        stream = c.mongo.job.watch(
+            [
+                {
+                    "$match": {
+                        "documentKey._id": ObjectId(job_id),
+                        "operationType": {"$in": ["update", "replace", "delete"]},
+                    }
+                }
+            ],
+            max_await_time_ms=10_000,
+        )
+    except OperationFailure:
+        stream = None
+
+    # Report that we reached this point
+    res = c.mongo.job.find_one_and_update(
+        query,
+        update={"$max": {f"barrier.{name}.{rank}": generation}},
+        projection={f"barrier.{name}": 1, "status": 1},
+        return_document=ReturnDocument.AFTER,
+    )
 
     # Wait until all the workers reached the barrier
-    while True:
-        res = mongo.job.find_one(query, {f"barrier.{name}": 1, "status": 1})
+    try:
+        while not _barrier_reached(res, name, n_workers, generation, desired_statuses):
+            if stream is None:
+                sleep(poll_interval)
+            else:
+                change = stream.try_next()
+                if change is not None and not _barrier_may_have_changed(change, name):
+                    continue
+                # Also re-check when nothing happened for a while, as a safety net
+            res = c.mongo.job.find_one(query, {f"barrier.{name}": 1, "status": 1})
+    finally:
+        if stream is not None:
+            stream.close()
+
 
-        if res is None:
-            sys.exit(1)
+def _barrier_reached(res, name, n_workers, generation, desired_statuses):
+    if res is None:
+        sys.exit(1)
 
-        if desired_statuses is not None and res["status"] not in desired_statuses:
-            print(f"Status is not in expected statuses {desired_statuses}. Exiting")
-            sys.exit(1)
+    if desired_statuses is not None and res["status"] not in desired_statuses:
+        print(f"Status is not in expected statuses {desired_statuses}. Exiting")
+        sys.exit(1)
+
+    arrivals = res.get("barrier", {}).get(name, {})
+    count = sum(1 for reached in arrivals.values() if reached >= generation)
+    if count >= n_workers:
+        print("... all workers registered. time to continue.")
+        return True
+    else:
+        print(f"... workers registered: {count} / {n_workers}")
+        return False
 
-        count = res.get("barrier", {}).get(name, 0)
-        if count >= desired_count:
-            print("... all workers registered. time to continue.")
-            break
-        else:
-            print(f"... workers registered: {count} / {desired_count}")
-            sleep(poll_interval)
+
+def _barrier_may_have_changed(change, name):
+    """Does a change stream event on the job touch the barrier count or the job status?"""
+    if change["operationType"] != "update":
+        return True
+    updated_fields = change["updateDescription"]["updatedFields"]
+    return any(
+        field in ["status", "barrier", f"barrier.{name}"] or field.startswith(f"barrier.{name}.")
+        for field in updated_fields
+    )
 
 
 class MultiLogChannel:
@@ -445,34 +992,253 @@ class FileLogChannel:
         return False
 
 
-class MongoLogChannel:
-    """Replacement for channels sys.stdout and sys.stderr to write logs in MongoDB"""
+class MetricBuffer:
+    """
+    Collects metric data points in memory, keyed by series hash, and writes them
+    to MongoDB in a single `bulk_write` from a background thread.
+
+    With a `bucket_collection`, points go to fixed-size bucket documents
+    (see jobmonitor.api.metric_series). Otherwise, each series gets one
+    `$push` with `$each` into `metric_data.<hash>` of the job document.
+    The list of series is always kept in the job's `metrics` field.
+    """
+
+    def __init__(
+        self, db, job_id, bucket_collection=None, max_points=10_000, flush_interval=1.0
+    ):
+        self.db = db.with_options(write_concern=WriteConcern(w=0))
+        self.job_id = job_id
+        self.bucket_collection = None
+        if bucket_collection is not None:
+            self.bucket_collection = bucket_collection.with_options(
+                write_concern=WriteConcern(w=0)
+            )
+        self.max_points = max_points
+        self._known_series = set()
+        self._new_series = []
+        self._points = {}
+        self._num_points = 0
+        # series hash -> (_id, number of points) of the bucket that is currently being filled
+        self._open_buckets = {}
+        self._lock = threading.Lock()
+        # Serializes flushes, so points of a series reach the database in order
+        self._flush_lock = threading.Lock()
+        self._flusher = BackgroundFlusher(self.flush, flush_interval)
+        self._flusher.start()
+
+    def add(self, key_hash, key_dict, values):
+        with self._lock:
+            if key_hash not in self._known_series:
+                self._known_series.add(key_hash)
+                self._new_series.append({**key_dict, "id": key_hash})
+            self._points.setdefault(key_hash, []).append(values)
+            self._num_points += 1
+            buffer_is_full = self._num_points >= self.max_points
+        if buffer_is_full:
+            self._flusher.wake()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                new_series, self._new_series = self._new_series, []
+                points, self._points = self._points, {}
+                self._num_points = 0
+
+            query = {"_id": ObjectId(self.job_id)}
+            job_operations = []
+            if new_series:
+                job_operations.append(
+                    UpdateOne(query, {"$push": {"metrics": {"$each": new_series}}})
+                )
+
+            if self.bucket_collection is None:
+                for key_hash, series_points in points.items():
+                    job_operations.append(
+                        UpdateOne(
+                            query, {"$push": {f"metric_data.{key_hash}": {"$each": series_points}}}
+                        )
+                    )
+            else:
+                bucket_operations = []
+                for key_hash, series_points in points.items():
+                    bucket_operations.extend(self._bucket_operations(key_hash, series_points))
+                if bucket_operations:
+                    self.bucket_collection.bulk_write(bucket_operations, ordered=False)
+
+            if job_operations:
+                self.db.bulk_write(job_operations, ordered=False)
+
+    def _bucket_operations(self, key_hash, series_points):
+        """Split the points over the open bucket of this series and new buckets"""
+        while series_points:
+            bucket_id, bucket_count = self._open_buckets.get(key_hash, (None, METRIC_BUCKET_SIZE))
+            if bucket_count >= METRIC_BUCKET_SIZE:
+                # This worker is the only writer of the series, so it can pick the bucket ids
+                bucket_id, bucket_count = ObjectId(), 0
+            chunk = series_points[: METRIC_BUCKET_SIZE - bucket_count]
+            series_points = series_points[len(chunk) :]
+            self._open_buckets[key_hash] = (bucket_id, bucket_count + len(chunk))
+            yield UpdateOne(
+                {"_id": bucket_id},
+                {
+                    "$setOnInsert": {
+                        "job_id": ObjectId(self.job_id),
+                        "series": key_hash,
+                        "first_time": chunk[0]["time"],
+                    },
+                    "$push": {"values": {"$each": chunk}},
+                    "$inc": {"count": len(chunk)},
+                    "$max": {"last_time": chunk[-1]["time"]},
+                },
+                upsert=True,
+            )
+
+    def close(self):
+        self._flusher.stop(timeout=5)
+        self.flush()
 
-    def __init__(self, db, job_id, field="logs", tags={}):
+
+class TimingBuffer:
+    """
+    Records durations per event in latency histograms (see jobmonitor.histogram) and
+    periodically adds them to `timing_histograms.<event>.<worker>` of the job document.
+    Each flush only sends the counts recorded since the previous flush, with `$inc`.
+    """
+
+    def __init__(self, db, job_id, rank, flush_interval=10.0):
+        self.db = db.with_options(write_concern=WriteConcern(w=0))
+        self.job_id = job_id
+        self.rank = rank
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._flusher = BackgroundFlusher(self.flush, flush_interval)
+        self._flusher.start()
+
+    def record(self, event, seconds):
+        with self._lock:
+            if event not in self._histograms:
+                self._histograms[event] = LatencyHistogram()
+            self._histograms[event].record(seconds)
+
+    def flush(self):
+        with self._lock:
+            histograms, self._histograms = self._histograms, {}
+        if not histograms:
+            return
+
+        update = {"$inc": {}, "$min": {}, "$max": {}}
+        for event, histogram in histograms.items():
+            prefix = f"timing_histograms.{event}.{self.rank}"
+            for index, count in histogram.buckets.items():
+                update["$inc"][f"{prefix}.buckets.{index}"] = count
+            update["$inc"][f"{prefix}.count"] = histogram.count
+            update["$inc"][f"{prefix}.sum"] = histogram.sum
+            update["$min"][f"{prefix}.min"] = histogram.min
+            update["$max"][f"{prefix}.max"] = histogram.max
+        self.db.update_one({"_id": ObjectId(self.job_id)}, update)
+
+    def close(self):
+        self._flusher.stop(timeout=5)
+        self.flush()
+
+
+class MongoLogChannel:
+    """
+    Replacement for channels sys.stdout and sys.stderr to write logs in MongoDB
+
+    By default, every line is written to the database immediately.
+    With `buffer_lines` set, lines are gathered in memory and pushed as one update
+    from a background thread when the buffer is full or every `flush_interval` seconds.
+    Call `close()` to write out whatever is still buffered.
+
+    Lines are pushed into `field` of the job document, or, with a `bucket_collection`,
+    into bucket documents per job and worker (see jobmonitor.api.job_logs).
+    """
+
+    def __init__(
+        self,
+        db,
+        job_id,
+        field="logs",
+        tags={},
+        buffer_lines=None,
+        flush_interval=0.5,
+        bucket_collection=None,
+    ):
         self.db = db
         self.job_id = job_id
         self.field = field
         self.tags = tags
+        self.bucket_collection = None
+        if bucket_collection is not None:
+            self.bucket_collection = bucket_collection.with_options(
+                write_concern=WriteConcern(w=0)
+            )
+        self.buffer_lines = buffer_lines
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._flusher = None
+        if buffer_lines is not None:
+            self._flusher = BackgroundFlusher(self._write_buffer, flush_interval)
+            self._flusher.start()
 
     def write(self, message):
         if message.strip() != "":
+            entry = {**self.tags, "message": message.strip(), "time": datetime.datetime.utcnow()}
+            if self._flusher is None:
+                self._push([entry])
+                return
+            with self._lock:
+                self._buffer.append(entry)
+                buffer_is_full = len(self._buffer) >= self.buffer_lines
+            if buffer_is_full:
+                self._flusher.wake()
+
+    def _write_buffer(self):
+        with self._lock:
+            entries, self._buffer = self._buffer, []
+        if entries:
+            self._push(entries)
+
+    def _push(self, entries):
+        if self.bucket_collection is None:
             self.db.update(
-                {"_id": ObjectId(self.job_id)},
-                {
-                    "$push": {
-                        self.field: {
-                            **self.tags,
-                            "message": message.strip(),
-                            "time": datetime.datetime.utcnow(),
-                        }
-                    }
-                },
-                w=0,
+                {"_id": ObjectId(self.job_id)}, {"$push": {self.field: {"$each": entries}}}, w=0
             )
+            return
+        # Append to buckets of this worker that have room for a chunk of lines, or start new
+        # ones. Several channels (stdout, stderr) write to the same buckets, so the database
+        # checks the room, and buckets never hold more than LOG_BUCKET_SIZE lines.
+        operations = []
+        for start in range(0, len(entries), LOG_BUCKET_SIZE):
+            chunk = entries[start : start + LOG_BUCKET_SIZE]
+            operations.append(
+                UpdateOne(
+                    {
+                        "job_id": ObjectId(self.job_id),
+                        "worker": self.tags.get("worker"),
+                        "count": {"$lte": LOG_BUCKET_SIZE - len(chunk)},
+                    },
+                    {
+                        "$push": {"lines": {"$each": chunk}},
+                        "$inc": {"count": len(chunk)},
+                        "$min": {"first_time": chunk[0]["time"]},
+                        "$max": {"last_time": chunk[-1]["time"]},
+                    },
+                    upsert=True,
+                )
+            )
+        self.bucket_collection.bulk_write(operations)
 
     def flush(self):
+        # Called after every write by MultiLogChannel, so this must not force a database write.
         pass
 
+    def close(self):
+        if self._flusher is not None:
+            self._flusher.stop(timeout=5)
+        self._write_buffer()
+
     def isatty(self):
         return False
 
@@ -1,9 +1,9 @@
 #!/usr/bin/env python3
 
-from bson.objectid import ObjectId
-
 import jobmonitor.delete
-from jobmonitor.connections import mongo
+from jobmonitor.lazy_loader import LazyLoader
+
+c = LazyLoader("c", globals(), "jobmonitor.connections")
 
 
 """
@@ -11,8 +11,10 @@ Kill a job if it is running on kubernetes
 """
 
 
-def star(job_id):
-    mongo.job.update_one({"_id": ObjectId(job_id)}, {"$set": {"annotations.star": True}})
+def star(jobs):
+    c.mongo.job.update_many(
+        {"_id": {"$in": [job["_id"] for job in jobs]}}, {"$set": {"annotations.star": True}}
+    )
 
 
 def main():
@@ -5,6 +5,8 @@ from argparse import ArgumentParser
 
 from bson.objectid import ObjectId
 
+from jobmonitor.histogram import LatencyHistogram
+
 
 """
 Show a job's timing data
@@ -13,39 +15,97 @@ Show a job's timing data
 
 def main():
     parser = ArgumentParser()
-    parser.add_argument("job_id", help="ID of the job")
-    parser.add_argument("--worker", "-w", help="Which worker? default: mean")
+    parser.add_argument("job_ids", nargs="+", help="ID of the job, histograms of several are merged")
+    parser.add_argument("--worker", "-w", help="Which worker? default: all")
+    parser.add_argument(
+        "--tails", "-t", default=False, action="store_true", help="compare workers' tail latencies"
+    )
+    parser.add_argument(
+        "--percentiles", "-p", default="50,90,95,99", help="comma-separated, default: 50,90,95,99"
+    )
     args = parser.parse_args()
 
-    from jobmonitor.connections import mongo
+    from jobmonitor.connections import mongo_reader as mongo
 
-    job = mongo.job.find_one({"_id": ObjectId(args.job_id)}, {"timings": 1})
+    percentiles = [float(p) for p in args.percentiles.split(",")]
 
-    if job is None:
-        print(fg("Job not found.", 1))
-        sys.exit(1)
+    jobs = []
+    for job_id in args.job_ids:
+        job = mongo.job.find_one({"_id": ObjectId(job_id)}, {"timings": 1, "timing_histograms": 1})
+        if job is None:
+            print(f"Job {job_id} not found.")
+            sys.exit(1)
+        jobs.append(job)
 
     import pandas as pd
 
-    timings = job.get("timings", {})
-
-    entries = []
-    for event, data in timings.items():
-        for worker_rank, stats in data.items():
-            entries.append({"event": event, "worker": worker_rank, **stats})
-
-    df = pd.DataFrame(entries)
-
-    df["time"] = df["mean"] * df["instances"]
-
-    del df["std"]
-
-    with pd.option_context("display.max_rows", None):
-        if not args.worker:
-            print(df.groupby("event").agg("mean"))
-        else:
-            print(f"Worker {args.worker}")
-            print(df[df.worker == args.worker].drop(["worker"], axis=1))
+    # (event, job id, worker) -> histogram
+    histograms = {}
+    for job in jobs:
+        for event, workers in job.get("timing_histograms", {}).items():
+            for worker_rank, document in workers.items():
+                if args.worker is None or worker_rank == args.worker:
+                    key = (event, str(job["_id"]), worker_rank)
+                    histograms[key] = LatencyHistogram.from_document(document)
+
+    with pd.option_context("display.max_rows", None, "display.width", None):
+        if histograms:
+            merged = {}
+            for (event, _, _), histogram in histograms.items():
+                merged.setdefault(event, LatencyHistogram()).merge(histogram)
+
+            entries = [summary(merged[event], percentiles, event=event) for event in merged]
+            print("Latency percentiles (seconds)")
+            print(pd.DataFrame(entries).set_index("event"))
+
+            if args.tails:
+                entries = []
+                for (event, job_id, worker_rank), histogram in sorted(histograms.items()):
+                    entry = summary(histogram, percentiles, event=event, worker=worker_rank)
+                    if len(jobs) > 1:
+                        entry["job"] = job_id
+                    # How much slower this worker's tail is than that of all workers together
+                    entry[f"p{percentiles[-1]:g} / all"] = histogram.quantile(
+                        percentiles[-1] / 100
+                    ) / merged[event].quantile(percentiles[-1] / 100)
+                    entries.append(entry)
+                print()
+                print("Per-worker tail latencies (seconds)")
+                print(pd.DataFrame(entries).set_index(["event", "worker"]))
+
+        # Summary statistics logged with `log_runtime`
+        for job in jobs:
+            timings = job.get("timings", {})
+            if not timings:
+                continue
+
+            entries = []
+            for event, data in timings.items():
+                for worker_rank, stats in data.items():
+                    entries.append({"event": event, "worker": worker_rank, **stats})
+
+            df = pd.DataFrame(entries)
+
+            df["time"] = df["mean"] * df["instances"]
+
+            del df["std"]
+
+            if histograms or len(jobs) > 1:
+                print()
+                print(f"Runtime statistics of job {job['_id']}")
+            if not args.worker:
+                print(df.groupby("event").agg("mean"))
+            else:
+                print(f"Worker {args.worker}")
+                print(df[df.worker == args.worker].drop(["worker"], axis=1))
+
+
+def summary(histogram, percentiles, **keys):
+    entry = {**keys, "count": histogram.count, "mean": histogram.mean()}
+    for p in percentiles:
+        entry[f"p{p:g}"] = histogram.quantile(p / 100)
+    entry["max"] = histogram.max
+    return entry
 
 
 if __name__ == "__main__":
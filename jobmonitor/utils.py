@@ -1,4 +1,14 @@
+import fcntl
+import hashlib
+import os
+import shutil
+import stat
+import sys
 import threading
+import traceback
+
+# ioctl request for a copy-on-write clone of a whole file (Linux, btrfs/xfs/...)
+FICLONE = 0x40049409
 
 
 class IntervalTimer(threading.Thread):
@@ -18,3 +28,69 @@ class IntervalTimer(threading.Thread):
         while not self.stopped.wait(self.interval):
             self.func()
         self.func()
+
+
+class BackgroundFlusher(threading.Thread):
+    """
+    Calls `flush_fn` every `interval` seconds from a daemon thread,
+    or earlier when `wake()` is called (e.g. because a buffer is full).
+    `stop()` runs a last flush before the thread terminates.
+    """
+
+    def __init__(self, flush_fn, interval=0.5):
+        threading.Thread.__init__(self, daemon=True)
+        self.flush_fn = flush_fn
+        self.interval = interval
+        self._wakeup = threading.Event()
+        self._stopped = False
+
+    def wake(self):
+        self._wakeup.set()
+
+    def stop(self, timeout=None):
+        self._stopped = True
+        self._wakeup.set()
+        if self.is_alive():
+            self.join(timeout=timeout)
+
+    def run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush_fn()
+            except Exception:
+                # Never take down the job because of a failed flush.
+                # Write to the original stderr, sys.stderr might be a log channel.
+                traceback.print_exc(file=sys.__stderr__)
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(1024 * 1024), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def make_private_dir(path):
+    """
+    Create a directory that only this user can access, or check that an existing one is owned
+    by this user and that nobody else can write to it. Raises PermissionError otherwise.
+    Files in a directory that another user can write to can be replaced or taken over.
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if (
+        not stat.S_ISDIR(info.st_mode)
+        or info.st_uid != os.getuid()
+        or info.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+    ):
+        raise PermissionError(f"{path} is not a directory that only this user can write to.")
+
+
+def reflink(source, target):
+    """Copy-on-write clone of a file. Raises OSError if the filesystem doesn't support it."""
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    shutil.copystat(source, target)
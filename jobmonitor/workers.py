@@ -17,7 +17,7 @@ def main():
     parser.add_argument("job_id", help="ID of the job")
     args = parser.parse_args()
 
-    from jobmonitor.connections import mongo
+    from jobmonitor.connections import mongo_reader as mongo
 
     job = mongo.job.find_one(
         {"_id": ObjectId(args.job_id)}, {"workers": 1, "registered_workers": 1, "n_workers": 1}
@@ -3,8 +3,10 @@
 """
 This finds orphan code packages---ones which no job refers to
 and deletes them to save space in MongoDB/GridFS.
+Then it deletes the file blobs that no remaining code package refers to.
 """
 
+from jobmonitor.api import blob_part_ids, code_package_manifest
 from jobmonitor.connections import mongo, gridfs
 
 
@@ -23,6 +25,25 @@ def main():
 
     print(f"{n_deleted} code packages deleted")
 
+    # Delete file blobs that no remaining package refers to, manifests included
+    used_hashes = set(mongo.fs.files.distinct("metadata.manifestBlob"))
+    for file in mongo.fs.files.find({"metadata.format": "blobs"}, {"_id": 1}):
+        manifest = code_package_manifest(file["_id"]) or []
+        used_hashes |= {entry["sha256"] for entry in manifest if "sha256" in entry}
+    n_deleted = 0
+    for blob in mongo.code_blob.find({"parts": {"$exists": False}, "data": {"$exists": True}}, {}):
+        if blob["_id"] not in used_hashes and "." not in blob["_id"]:
+            mongo.code_blob.delete_one({"_id": blob["_id"]})
+            n_deleted += 1
+    for blob in mongo.code_blob.find({"parts": {"$exists": True}}):
+        if blob["_id"] not in used_hashes:
+            # Delete the head first, so the blob never looks complete while parts are missing
+            mongo.code_blob.delete_one({"_id": blob["_id"]})
+            mongo.code_blob.delete_many({"_id": {"$in": blob_part_ids(blob)}})
+            n_deleted += 1
+
+    print(f"{n_deleted} file blobs deleted")
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+"""
+This moves the `metric_data` arrays out of job documents
+into fixed-size documents in the `metric_bucket` collection.
+Run it when no workers of an older jobmonitor version are still writing `metric_data`.
+"""
+
+from argparse import ArgumentParser
+
+from jobmonitor.api import METRIC_BUCKET_INDEX, METRIC_BUCKET_SIZE
+from jobmonitor.connections import mongo
+
+
+def to_buckets(job_id, series_id, values):
+    for start in range(0, len(values), METRIC_BUCKET_SIZE):
+        chunk = values[start : start + METRIC_BUCKET_SIZE]
+        yield {
+            "job_id": job_id,
+            "series": series_id,
+            "first_time": chunk[0].get("time"),
+            "last_time": chunk[-1].get("time"),
+            "count": len(chunk),
+            "values": chunk,
+        }
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--dry-run", default=False, action="store_true")
+    args = parser.parse_args()
+
+    mongo.metric_bucket.create_index(METRIC_BUCKET_INDEX)
+
+    n_jobs = 0
+    n_buckets = 0
+
+    job_ids = [job["_id"] for job in mongo.job.find({"metric_data": {"$exists": True}}, {"_id": 1})]
+    for job_id in job_ids:
+        # Load one job at a time, these documents can be large
+        job = mongo.job.find_one({"_id": job_id}, {"metric_data": 1})
+        metric_data = job.get("metric_data") or {}
+
+        buckets = []
+        for series_id, values in metric_data.items():
+            buckets.extend(to_buckets(job_id, series_id, values))
+
+        print(f"{job_id}: {len(metric_data)} series, {len(buckets)} buckets")
+        n_jobs += 1
+        n_buckets += len(buckets)
+        if args.dry_run:
+            continue
+
+        # Remove leftovers of an earlier, interrupted migration of this job
+        mongo.metric_bucket.delete_many({"job_id": job_id, "series": {"$in": list(metric_data)}})
+        if buckets:
+            mongo.metric_bucket.insert_many(buckets)
+        mongo.job.update_one({"_id": job_id}, {"$unset": {"metric_data": 1}})
+
+    action = "would be created" if args.dry_run else "created"
+    print(f"{n_buckets} buckets {action} from {n_jobs} jobs")
+
+
+if __name__ == "__main__":
+    main()
@@ -17,6 +17,7 @@ setup(
         "kubernetes",
         "schema",
     ],
+    extras_require={"zstd": ["zstandard"], "lz4": ["lz4"], "test": ["pytest", "mongomock"]},
     entry_points={
         "console_scripts": [
             "jobrun=jobmonitor.run:main",
@@ -30,6 +31,10 @@ setup(
             "jobmeld=jobmonitor.meld:main",
             "jobworkers=jobmonitor.workers:main",
             "jobtimings=jobmonitor.timings:main",
+            "jobprofile=jobmonitor.profiles:main",
+            "jobheartbeat=jobmonitor.heartbeat:main",
+            "jobreaper=jobmonitor.reaper:main",
+            "jobmonitor-admin=jobmonitor.admin:main",
             "kuberun=jobmonitor.kuberun:main",
         ]
     },
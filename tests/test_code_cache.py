@@ -0,0 +1,39 @@
+import os
+
+import pytest
+
+pytest.importorskip("pymongo")
+
+from jobmonitor import code_cache
+
+
+@pytest.fixture
+def package(monkeypatch):
+    def download_code_package(package_id, destination):
+        os.makedirs(os.path.join(destination, "pkg", "empty"))
+        with open(os.path.join(destination, "pkg", "module.py"), "w") as fp:
+            fp.write("x = 1\n")
+        os.symlink("pkg", os.path.join(destination, "pkglink"))
+        os.symlink("module.py", os.path.join(destination, "pkg", "filelink.py"))
+
+    monkeypatch.setattr(code_cache, "download_code_package", download_code_package)
+    return "5be59ae368999dde8ed9545d"
+
+
+def test_fetch_through_cache(tmp_path, package):
+    cache_dir = str(tmp_path / "cache")
+    for name in ["job1", "job2"]:
+        destination = str(tmp_path / name)
+        code_cache.fetch_code_package(package, destination, cache_dir=cache_dir)
+
+        assert open(os.path.join(destination, "pkg", "module.py")).read() == "x = 1\n"
+        assert os.path.isdir(os.path.join(destination, "pkg", "empty"))
+        assert os.readlink(os.path.join(destination, "pkg", "filelink.py")) == "module.py"
+        assert os.readlink(os.path.join(destination, "pkglink")) == "pkg"
+        assert os.path.isfile(os.path.join(destination, "pkglink", "module.py"))
+
+
+def test_cache_dir_is_private(tmp_path, package):
+    cache_dir = str(tmp_path / "cache")
+    code_cache.fetch_code_package(package, str(tmp_path / "job"), cache_dir=cache_dir)
+    assert os.stat(cache_dir).st_mode & 0o777 == 0o700
@@ -0,0 +1,55 @@
+import datetime
+import types
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+from bson.objectid import ObjectId
+
+from jobmonitor import reaper
+
+
+@pytest.fixture
+def mongo(monkeypatch):
+    database = mongomock.MongoClient().db
+    monkeypatch.setattr(reaper, "c", types.SimpleNamespace(mongo=database))
+    return database
+
+
+def running_job(workers):
+    now = datetime.datetime.utcnow()
+    return {
+        "_id": ObjectId(),
+        "status": "RUNNING",
+        "n_workers": len(workers),
+        "start_time": now - datetime.timedelta(hours=1),
+        "last_heartbeat_time": now,
+        "workers": workers,
+    }
+
+
+def test_finished_worker_is_not_dead(mongo):
+    now = datetime.datetime.utcnow()
+    long_ago = now - datetime.timedelta(seconds=2 * reaper.DEAD_AFTER)
+    mongo.job.insert_one(
+        running_job(
+            {
+                "0": {"last_heartbeat_time": now},
+                "1": {"last_heartbeat_time": long_ago, "end_time": long_ago},
+            }
+        )
+    )
+    assert reaper.find_dead_jobs() == []
+
+
+def test_silent_worker_is_dead(mongo):
+    now = datetime.datetime.utcnow()
+    long_ago = now - datetime.timedelta(seconds=2 * reaper.DEAD_AFTER)
+    job = running_job(
+        {"0": {"last_heartbeat_time": now}, "1": {"last_heartbeat_time": long_ago}}
+    )
+    mongo.job.insert_one(job)
+    dead_jobs = reaper.find_dead_jobs()
+    assert [dead_job["_id"] for dead_job in dead_jobs] == [job["_id"]]
+    assert dead_jobs[0]["dead_workers"] == ["1"]